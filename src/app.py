@@ -2,31 +2,63 @@ import os
 import shutil
 import asyncio
 import json
+import time
 from textwrap import dedent
 from typing import Dict, Any, List
 from fastapi import (FastAPI,
+    HTTPException,
+    Request,
     WebSocket,
     WebSocketDisconnect,
     UploadFile,
     File,
 )
 
-from fastapi.responses import HTMLResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, StreamingResponse, FileResponse
 # from openai import AsyncOpenAI
 # --- New Imports for the Async Agent ---
 from .streaming import (
     function_worker_async,
     call_function,
     astream_llama_cpp_response,
+    astream_llama_cpp_completion,
     client_cfg,
 )
-from .utils import create_message_with_files
-from .sandbox_manager import close_sandbox
+from .chat_template import (
+    FN_NAME,
+    FN_ARGS,
+    FN_RESULT,
+    FN_EXIT,
+    get_prompt_cache,
+    drop_prompt_cache,
+    close_tokenizer,
+    token_count_source,
+)
+from .tool_grammar import tool_call_constraints
+from .tools import available_tools, close_tools
+from .utils import create_message_with_files, load_session_files
+from .sandbox_manager import close_sandbox, release_sandbox
+from .session_store import get_session_store, new_session_state, WORKER_ID, SESSION_TTL_SECONDS
+from .static_assets import asset_response, preload_static_assets
+from .config import validate_config, env_float
+from .protocol import HtmxEmitter, NullEmitter, get_emitter
+from . import profiling
+from .file_profiler import schedule_profile, get_profile, format_profile, shutdown_profiler
+from .batch import (
+    BATCH_CONCURRENCY,
+    job_dir,
+    parse_items,
+    resolve_item_files,
+    load_job_items,
+    start_job,
+    job_status,
+    results_path,
+    cancel_batch_jobs,
+)
 from .markdown_functional import (
     process_markdown_stream,
     finalize_markdown as finalize_markdown_text,
-    md as md_parser
+    render_markdown,
 )
 import uuid
 
@@ -41,11 +73,6 @@ react_instructions = {
         - Do not provide a final answer until there are no errors from your code tool.""")
 }
 
-FN_NAME = '✿FUNCTION✿'
-FN_ARGS = '✿ARGS✿'
-FN_RESULT = '✿RESULT✿'
-FN_EXIT = '✿RETURN✿'
-
 FN_CALL_TEMPLATE_EN = """
 
 # Tools
@@ -66,62 +93,85 @@ FN_CALL_TEMPLATE_EN = """
     FN_EXIT,
 )
 
-AVAILABLE_TOOLS = [
-    {
-        "type": "function",
-        "function": {
-            "name": "run_code_interpreter",
-            "description": "A powerful Python code execution environment for complex math, data analysis, and general programming tasks. Input only raw Python code, no explanation needed.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "code": {
-                        "type": "string",
-                        "description": "The python code to execute."
-                    },
-                },
-                "required": ["code"],
-                
-            },
-            "strict": False
-        }
-    },
-]
+# Schemas of the registered tools enabled by UFD_TOOLS (see tools.py).
+AVAILABLE_TOOLS = available_tools()
 
 # This will hold our persistent agent components
 agent_context: Dict[str, Any] = {}
 
+# How long a sandbox outlives its websocket, so a dropped client can reconnect
+# with its session token and pick up where it left off.
+SESSION_GRACE_SECONDS = env_float("UFD_SESSION_GRACE_SECONDS", 300)
+SESSION_PURGE_INTERVAL = 600
+# Tool calls are dequeued by this many workers; each tool then applies its own limit (see tools.py).
+TOOL_WORKERS = max(1, int(env_float("UFD_TOOL_WORKERS", 4)))
+
 # --- FastAPI Setup ---
 app = FastAPI()
-app.mount("/static", StaticFiles(directory="src/static"), name="static")
+if profiling.PROFILING_ENABLED:
+    app.include_router(profiling.router)
 
 @app.on_event("startup")
 async def startup_event():
     """Initializes the agent components when the application starts."""
     print("--- Application starting up... ---")
+    for problem in validate_config():
+        print(f"--- Config warning: {problem} ---")
+    await asyncio.to_thread(preload_static_assets)
+    profiling.start_profiling()
     agent_context["call_queue"] = asyncio.Queue()
     agent_context["result_queue"] = asyncio.Queue()
+    agent_context["pending_closes"] = {}
+    # Open websocket connections per session in this process.
+    agent_context["attached"] = {}
+    agent_context["purge_task"] = asyncio.create_task(purge_expired_sessions())
     # agent_context["client"] = AsyncOpenAI(api_key="EMPTY")
-    agent_context["worker_task"] = asyncio.create_task(function_worker_async(
-        call_function,
-        call_queue=agent_context["call_queue"],
-        result_queue=agent_context["result_queue"],
-    ))
-    print("--- Agent worker started in the background. ---")
+    agent_context["worker_tasks"] = [
+        asyncio.create_task(function_worker_async(
+            call_function,
+            call_queue=agent_context["call_queue"],
+            result_queue=agent_context["result_queue"],
+        ))
+        for _ in range(TOOL_WORKERS)
+    ]
+    print(f"--- {TOOL_WORKERS} agent workers started in the background. ---")
+
+async def purge_expired_sessions():
+    """ Periodically deletes detached sessions older than SESSION_TTL_SECONDS. """
+    while True:
+        await asyncio.sleep(SESSION_PURGE_INTERVAL)
+        try:
+            if purged := await asyncio.to_thread(get_session_store().purge_expired, SESSION_TTL_SECONDS):
+                print(f"--- Purged {purged} expired sessions. ---")
+        except Exception as e:
+            print(f"--- Session purge failed: {e} ---")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Gracefully shuts down the agent worker."""
     print("--- Application shutting down... ---")
-    if "worker_task" in agent_context and not agent_context["worker_task"].done():
-        agent_context["call_queue"].put_nowait(None)
-        agent_context["worker_task"].cancel()
+    workers = [task for task in agent_context.get("worker_tasks", []) if not task.done()]
+    if workers:
+        for task in workers:
+            agent_context["call_queue"].put_nowait(None)
+            task.cancel()
         await asyncio.sleep(1)
+    if task := agent_context.get("purge_task"):
+        task.cancel()
+    await cancel_batch_jobs()
+    await close_tools()
+    await close_tokenizer()
+    profiling.stop_profiling()
+    shutdown_profiler()
     print("--- Agent worker shut down. ---")
 
 @app.get("/", response_class=HTMLResponse)
-async def get_index():
-    return FileResponse("src/static/index.html")
+async def get_index(request: Request):
+    return asset_response(request, "index.html")
+
+@app.get("/static/{path:path}")
+async def get_static(request: Request, path: str):
+    return asset_response(request, path)
 
 
 @app.post("/upload-file")
@@ -133,21 +183,173 @@ async def upload_file(files: list[UploadFile] = File(...)):
         file_path = f"tmp/{file.filename}"
         with open(file_path, "wb") as f:
             f.write(contents)
+        # Profile tabular data in the background while the user writes the prompt.
+        await schedule_profile(file.filename, contents, upload_path=file_path)
         file_paths.append(file_path)
     return HTMLResponse(content="".join([f'<input type="hidden" name="uploaded_file_paths" value="{path}">' for path in file_paths]))
                    
 
+async def run_batch_item(item: Dict[str, Any], session_id: str) -> Dict[str, Any]:
+    """ Runs one batch prompt through the agent loop as a fresh conversation. """
+    session_files = resolve_item_files(item.get("files", []))
+    file_summaries = []
+    for f in session_files:
+        if profile := await get_profile(f["path"], f["data"]):
+            file_summaries.append(format_profile(f["path"], profile))
+    user_message = create_message_with_files(item["prompt"], [f["path"] for f in session_files], file_summaries)
+    emitter = NullEmitter()
+    answer = await agent_stream_logic(
+        emitter=emitter,
+        messages=[react_instructions] + user_message,
+        show_reasoning=True,
+        response_id=uuid.uuid4().hex,
+        max_iterations=int(item.get("max_iterations", 5)),
+        session_files=session_files,
+        session_id=session_id,
+    )
+    return {
+        "answer": answer,
+        "tool_calls": len(emitter.tool_statuses),
+        "errors": emitter.errors,
+        "timings": {"first_token_ms": emitter.first_token_ms},
+    }
+
+@app.post("/batch")
+async def create_batch_job(request: Request, job_id: str = None, concurrency: int = BATCH_CONCURRENCY, max_iterations: int = 5):
+    """
+    Runs a JSONL body of prompts and streams their results back as JSONL as
+    they finish. Posting again with an existing `job_id` (and an empty body)
+    resumes that job from its stored input.
+    """
+    body = (await request.body()).decode("utf-8")
+    job_id = job_id or uuid.uuid4().hex
+    try:
+        job_dir(job_id)
+        items = parse_items(body) if body.strip() else load_job_items(job_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if items is None:
+        raise HTTPException(status_code=404, detail="Unknown batch job.")
+    if not items:
+        raise HTTPException(status_code=400, detail="No items to run.")
+    for item in items:
+        item.setdefault("max_iterations", max_iterations)
+    try:
+        job = start_job(job_id, items, concurrency, run_batch_item)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return StreamingResponse(
+        job.follow(job.subscribe()),
+        media_type="application/x-ndjson",
+        headers={"X-Batch-Job": job_id},
+    )
+
+@app.get("/batch/{job_id}")
+async def get_batch_job(job_id: str):
+    try:
+        status = job_status(job_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown batch job.")
+    return status
+
+@app.get("/batch/{job_id}/results")
+async def get_batch_results(job_id: str):
+    """ Every result recorded so far, including those of earlier runs of the job. """
+    try:
+        path = results_path(job_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="No results for this job yet.")
+    return FileResponse(path, media_type="application/x-ndjson")
+
+
+def schedule_sandbox_close(session_id: str):
+    """
+    Marks the session as detached and kills its sandbox once the grace period
+    passes, unless a reconnect (on any worker) has reattached it in the meantime.
+    """
+    store = get_session_store()
+    detached_at = time.time()
+
+    async def close_later():
+        detach = asyncio.ensure_future(asyncio.to_thread(store.update, session_id, detached_at=detached_at))
+        try:
+            await asyncio.shield(detach)
+            await asyncio.sleep(SESSION_GRACE_SECONDS)
+        except asyncio.CancelledError:
+            # Reattached: let our write land before the reattach clears it.
+            await detach
+            raise
+        agent_context["pending_closes"].pop(session_id, None)
+        # Claim the close in one step: a reattach on any worker clears
+        # detached_at first, and then this claim fails. Clearing sandbox_id
+        # here means a later reattach creates a fresh sandbox.
+        claimed = await asyncio.to_thread(store.update_if, session_id, {"detached_at": detached_at}, sandbox_id=None)
+        if claimed is not None:
+            print(f"--- Grace period expired for session {session_id}. Closing sandbox. ---")
+            drop_prompt_cache(session_id)
+            profiling.forget_session(session_id)
+            await asyncio.to_thread(close_sandbox, session_id, claimed.get("sandbox_id"))
+        else:
+            release_sandbox(session_id)
+
+    agent_context["pending_closes"][session_id] = asyncio.create_task(close_later())
+
+async def cancel_sandbox_close(session_id: str):
+    """ Reattaches a detached session so its pending close becomes a no-op. """
+    if task := agent_context["pending_closes"].pop(session_id, None):
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    await asyncio.to_thread(get_session_store().update, session_id, detached_at=None, worker=WORKER_ID)
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    session_id = str(uuid.uuid4())
-    
     # --- New Session State ---
-    chat_history = [react_instructions]
-    session_files = []
-    # -------------------------
-
+    # The store is shared by all workers; the locals below are this
+    # connection's working copy. The history is rebuilt from the turn log
+    # and each finished turn is appended to it, never rewritten. Store calls
+    # run in a thread: SQLite may wait on another worker's write lock.
+    store = get_session_store()
+    session_token = websocket.query_params.get("session")
+    state = await asyncio.to_thread(store.get, session_token) if session_token else None
+
+    session_id = session_token if state is not None else str(uuid.uuid4())
+    emitter = get_emitter(websocket)
+    # Counted before anything can fail, so the finally below always undoes it
+    # and schedules the close, even if the client drops during the replay.
+    attached = agent_context["attached"]
+    attached[session_id] = attached.get(session_id, 0) + 1
     try:
+        if state is not None:
+            await cancel_sandbox_close(session_id)
+            print(f"--- Resuming session {session_id} ---")
+        else:
+            state = new_session_state()
+            await asyncio.to_thread(store.put, session_id, state)
+        turns = await asyncio.to_thread(store.get_turns, session_id)
+        chat_history = [react_instructions] + [m for turn_record in turns for m in turn_record["messages"]]
+        session_files = load_session_files(state["files"])
+        # -------------------------
+
+        # Sticky-routing hint: a proxy can hash on this cookie to pin the client
+        # to the worker that holds its sandbox handle.
+        await websocket.accept(headers=[
+            (b"set-cookie", f"ufd_worker={WORKER_ID}; Path=/; SameSite=Lax".encode()),
+        ])
+        await emitter.session_token(session_id)
+
+        # Replay the stored transcript; the model is not re-run. The ws extension
+        # reconnects on its own into a page that still shows the transcript, so
+        # start from an empty chat.
+        if turns:
+            await emitter.clear_chat()
+        for turn_record in turns:
+            await emitter.user_bubble(turn_record["user_html"])
+            await emitter.answer_bubble(turn_record["answer_html"])
+
         while True:
             response_id = int(asyncio.get_running_loop().time() * 1000)
             session_dir = f"tmp/{response_id}"
@@ -167,6 +369,7 @@ async def websocket_endpoint(websocket: WebSocket):
 
             # --- File Handling for Session ---
             newly_uploaded_files = []
+            file_summaries = []
             if uploaded_file_paths:
                 for path in uploaded_file_paths:
                     if os.path.exists(path):
@@ -174,8 +377,13 @@ async def websocket_endpoint(websocket: WebSocket):
                         shutil.move(path, new_path)
                         with open(new_path, "rb") as f:
                             file_data = f.read()
-                        session_files.append({"path": os.path.basename(new_path), "data": file_data})
+                        session_files.append({"path": os.path.basename(new_path), "data": file_data, "local_path": new_path})
                         newly_uploaded_files.append(new_path)
+                        if profile := await get_profile(os.path.basename(new_path), file_data, upload_path=path):
+                            file_summaries.append(format_profile(os.path.basename(new_path), profile))
+                await asyncio.to_thread(store.update, session_id, files=[
+                    {"path": f["path"], "local_path": f["local_path"]} for f in session_files
+                ])
             
             file_list_html = ""
             if newly_uploaded_files:
@@ -185,75 +393,80 @@ async def websocket_endpoint(websocket: WebSocket):
             
             display_prompt = prompt + file_list_html
             
-            user_bubble = f'''
-                <div hx-swap-oob="beforeend:#chat-messages">
-                    <div class="flex justify-end">
-                        <div class="chat-bubble bg-primary text-white p-3 rounded-lg">
-                            {display_prompt}
-                        </div>
-                    </div>
-                </div>
-            '''
-            await websocket.send_text(user_bubble)
-
+            await emitter.user_bubble(display_prompt)
             if show_reasoning:
-                reasoning_bubble = f'''
-                    <div hx-swap-oob="beforeend:#chat-messages">
-                        <div class="flex justify-start">
-                            <div class="chat-bubble bg-gray-200 text-gray-800 p-3 rounded-xl">
-                                <b>Reasoning:</b>
-                                <div id='reasoning-{response_id}'></div>
-                            </div>
-                        </div>
-                    </div>
-                '''
-                await websocket.send_text(reasoning_bubble)
-
-            content_bubble = f'''
-                <div hx-swap-oob="beforeend:#chat-messages">
-                    <div class="flex justify-start">
-                        <div class="chat-bubble bg-gray-200 text-gray-800 p-3 rounded-xl">
-                            <div id='content-{response_id}'></div>
-                        </div>
-                    </div>
-                </div>
-            '''
-            await websocket.send_text(content_bubble)
+                await emitter.reasoning_bubble(f"reasoning-{response_id}")
+            await emitter.content_bubble(f"content-{response_id}")
 
             # --- Updated Agent Logic Call ---
             # 1. Create the user message for this specific turn
-            user_message_for_turn = create_message_with_files(prompt, [f['path'] for f in session_files])
+            user_message_for_turn = create_message_with_files(prompt, [f['path'] for f in session_files], file_summaries)
 
             # 2. Construct the message list for this agent run
             messages_for_this_run = chat_history + user_message_for_turn
             
             # 3. Call the agent and get the final answer
-            final_answer_text = await agent_stream_logic(
-                websocket=websocket,
-                messages=messages_for_this_run,
-                show_reasoning=show_reasoning,
-                response_id=response_id,
-                max_iterations=max_iterations,
-                session_files=session_files,
-                session_id=session_id
-            )
+            with profiling.session_lag(session_id):
+                final_answer_text = await agent_stream_logic(
+                    emitter=emitter,
+                    messages=messages_for_this_run,
+                    show_reasoning=show_reasoning,
+                    response_id=response_id,
+                    max_iterations=max_iterations,
+                    session_files=session_files,
+                    session_id=session_id
+                )
 
             # 4. Permanently update the chat history for the next turn
+            assistant_message = {"role": "assistant", "content": final_answer_text}
             chat_history.extend(user_message_for_turn)
-            chat_history.append({"role": "assistant", "content": final_answer_text})
+            chat_history.append(assistant_message)
+
+            # 5. Checkpoint the turn so a reconnect can rehydrate and replay it
+            files_manifest = [{"path": f["path"], "local_path": f["local_path"]} for f in session_files]
+            await asyncio.to_thread(store.append_turn, session_id, {
+                "response_id": response_id,
+                "messages": user_message_for_turn + [assistant_message],
+                "user_html": display_prompt,
+                "answer_html": render_markdown(final_answer_text),
+                "files": files_manifest,
+            })
+            await asyncio.to_thread(store.update, session_id, worker=WORKER_ID)
             # --------------------------------
 
     except WebSocketDisconnect:
         print("Client disconnected from WebSocket.")
     except Exception as e:
         print(f"WebSocket error: {e}")
-        error_html = f'<div hx-swap-oob="beforeend:#chat-messages" class="text-sm text-red-500">[WebSocket Error]: {e}</div>'
-        await websocket.send_text(error_html)
+        await emitter.error(None, f"[WebSocket Error]: {e}")
     finally:
-        close_sandbox(session_id)
+        # Another connection (e.g. a duplicated tab) may still be using the session.
+        attached[session_id] -= 1
+        if not attached[session_id]:
+            del attached[session_id]
+            schedule_sandbox_close(session_id)
+
+# Keeps fire-and-forget tasks referenced until they finish.
+_background_tasks = set()
+
+def log_prompt_tokens(prompt_cache):
+    """
+    Logs the prompt's token count in the background. It only feeds a log
+    line, so generation never waits on the extra /tokenize request.
+    """
+    async def count():
+        try:
+            if (tokens := await prompt_cache.count_tokens(client_cfg)) is not None:
+                print(f"--- Prompt tokens ({token_count_source()}): {tokens} ---")
+        except Exception as e:
+            print(f"--- Could not count prompt tokens: {e} ---")
+
+    task = asyncio.create_task(count())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
 async def agent_stream_logic(
-    websocket: WebSocket,
+    emitter: HtmxEmitter,
     messages: List[Dict[str, Any]],
     show_reasoning: bool,
     response_id: str,
@@ -262,19 +475,14 @@ async def agent_stream_logic(
     session_id: str
 ) -> str:
     """
-    The main agent loop, now sending HTML directly over WebSocket.
+    The main agent loop, sending UI updates through the session's emitter.
     Accepts the full message history and returns the final answer text.
     """
     current_messages = list(messages)
     print(f"CURRENT_MESSAGES: {current_messages}")
     call_queue = agent_context["call_queue"]
-    result_queue = agent_context["result_queue"]
-
-    # Clear queues for this run
-    while not call_queue.empty():
-        call_queue.get_nowait()
-    while not result_queue.empty():
-        result_queue.get_nowait()
+    # The call queue is shared by every run; results come back on this run's own queue.
+    result_queue = asyncio.Queue()
 
     content_id = f"content-{response_id}"
     reasoning_id = f"reasoning-{response_id}"
@@ -282,18 +490,34 @@ async def agent_stream_logic(
     next_turn_messages = []
     final_answer_text = ""
     error_in_previous_turn = False
-    
+
+    # Raw mode keeps a locally rendered prompt per session and only ever
+    # appends to it, so llama-server can reuse its KV cache for the prefix.
+    raw_mode = client_cfg.get("mode") == "raw"
+    prompt_cache = get_prompt_cache(session_id, client_cfg["model_name"], AVAILABLE_TOOLS) if raw_mode else None
+
     try:
+        if raw_mode:
+            prompt_cache.sync(current_messages)
         for turn in range(max_iterations):
             print(f"----TURN: {turn} ----")
+            is_correction_turn = error_in_previous_turn
             current_messages.extend(next_turn_messages)
             next_turn_messages.clear()
             print(f"----- CURRENT_MESSAGES: {current_messages}")
 
-            clear_content_html = f'<div hx-swap-oob="innerHTML:#{content_id}"></div>'
-            await websocket.send_text(clear_content_html)
+            await emitter.replace_block(content_id, "")
 
-            stream = astream_llama_cpp_response(messages=current_messages, tools=AVAILABLE_TOOLS, client_cfg=client_cfg)
+            if raw_mode:
+                log_prompt_tokens(prompt_cache)
+                stream = astream_llama_cpp_completion(
+                    prompt=prompt_cache.prompt(),
+                    client_cfg=client_cfg,
+                    tools=AVAILABLE_TOOLS,
+                    constraints=tool_call_constraints(AVAILABLE_TOOLS, prompt_cache.template.tool_format),
+                )
+            else:
+                stream = astream_llama_cpp_response(messages=current_messages, tools=AVAILABLE_TOOLS, client_cfg=client_cfg)
             
             content_buffer = ""
             reasoning_buffer = ""
@@ -301,33 +525,47 @@ async def agent_stream_logic(
             stable_text = ""
             tool_calls = []
             finish_reason = None
+            raw_text = ""
+            stream_failed = False
 
             async for event in stream:
+                if event is None:
+                    # The request to llama-server failed (unreachable or timed out).
+                    stream_failed = True
+                    break
                 if not event or event[0] is None:
                     continue
                 delta = event[0].get("delta", {})
                 if fr := event[0].get("finish_reason"):
                     finish_reason = fr
+                if "raw_text" in event[0]:
+                    raw_text = event[0]["raw_text"]
                 if reasoning := delta.get("reasoning_content"):
                     reasoning_buffer += reasoning
                     if show_reasoning:
-                        html_chunk = f'<div hx-swap-oob="beforeend:#{reasoning_id}">{reasoning}</div>'
-                        await websocket.send_text(html_chunk)
+                        await emitter.append_reasoning(reasoning_id, reasoning)
                 if content := delta.get("content"):
                     content_buffer += content
+                    previous_stable_text = stable_text
                     unstable_buffer, stable_text = process_markdown_stream(content, unstable_buffer, stable_text)
-                    if stable_text:
-                        html_fragment = md_parser.render(stable_text)
-                        html_chunk = f'<div hx-swap-oob="innerHTML:#{content_id}">{html_fragment}</div>'
-                        await websocket.send_text(html_chunk)
+                    if emitter.streams_tokens:
+                        # Send the raw token and only re-render once a markdown
+                        # block (paragraph or fenced code) has been completed.
+                        await emitter.append_token(content_id, content)
+                        if stable_text != previous_stable_text and stable_text.endswith("\n\n"):
+                            await emitter.replace_block(content_id, render_markdown(stable_text), unstable_buffer)
+                    elif stable_text:
+                        await emitter.replace_block(content_id, render_markdown(stable_text))
                 if tc := delta.get("tool_calls"):
                     tool_calls.extend(tc)
 
+            if stream_failed:
+                await emitter.error(content_id, "[Error]: The model server could not be reached.")
+                return "An error occurred: the model server could not be reached."
+
             final_text = finalize_markdown_text(unstable_buffer, stable_text)
             if final_text:
-                final_html = md_parser.render(final_text)
-                html_chunk = f'<div hx-swap-oob="innerHTML:#{content_id}">{final_html}</div>'
-                await websocket.send_text(html_chunk)
+                await emitter.replace_block(content_id, render_markdown(final_text))
             
             final_answer_text = final_text
 
@@ -337,21 +575,27 @@ async def agent_stream_logic(
                 assistant_message_for_history = {"role": "assistant", "content": content_buffer or "", "tool_calls": tool_calls}
                 results = []
                 for call in tool_calls:
-                    tool_html = f'<div hx-swap-oob="beforeend:#chat-messages" class="text-sm text-blue-500"> Executing {call["function"]["name"]}...</div>'
-                    await websocket.send_text(tool_html)
-                    await call_queue.put({"tool_call": json.dumps(call), "files": session_files, "session_id": session_id})
+                    await emitter.tool_status(f'Executing {call["function"]["name"]}...')
+                    await call_queue.put({
+                        "tool_call": json.dumps(call),
+                        "files": session_files,
+                        "session_id": session_id,
+                        "result_queue": result_queue,
+                    })
                 
-                await call_queue.join()
-                
-                while not result_queue.empty():
-                    result = await result_queue.get()
-                    results.append(result)
-                    result_queue.task_done()
+                for _ in tool_calls:
+                    results.append(await result_queue.get())
+                # Workers finish in any order; the model expects results in call order.
+                order = {call.get("id"): index for index, call in enumerate(tool_calls)}
+                results.sort(key=lambda res: order.get(res.get("tool_call_id"), len(order)))
                 
                 # Set the flag for the *next* turn if an error occurred.
                 error_in_previous_turn = any(res.get("is_error", False) for res in results)
                 next_turn_messages.append(assistant_message_for_history)
                 next_turn_messages.extend(results)
+                if raw_mode:
+                    prompt_cache.append_generation(raw_text)
+                    prompt_cache.append_messages(results)
                 print(f"--- NXT_MSGS: {next_turn_messages}")
 
             # 3. Decide whether to continue the loop.
@@ -359,36 +603,35 @@ async def agent_stream_logic(
                 # The model wants to stop, and it wasn't a correction turn.
                 # This is a genuine, clean stop.
                 print(f"Loop ended cleanly. Finish reason: {finish_reason}")
+                if raw_mode:
+                    prompt_cache.append_generation(raw_text)
+                    # The caller appends exactly this message to the chat history.
+                    prompt_cache.cover({"role": "assistant", "content": final_answer_text})
                 break
             else:
                 # We continue if:
                 # 1. The model issued a tool call (`finish_reason` was 'tool_calls').
                 # 2. The model tried to stop, but it was during a correction turn, so we force it to try again.
                 continue
+        else:
+            # Never reached a clean stop; report it so callers (e.g. batch
+            # jobs) don't take the last partial text for an answer.
+            await emitter.error(content_id, f"[Error]: No final answer after {max_iterations} iterations.")
 
         if show_reasoning:
-            script_container_id = f"script-container-{response_id}"
-            script_html = f'''
-        <div id={script_container_id} hx-swap-oob="beforeend:#chat-messages">
-            <script>
-                addShowMore(f"reasoning-{response_id}");
-                const scriptContainer = document.getElementById('{script_container_id}');
-                if (scriptContainer) {{
-                    scriptContainer.remove();
-                }}
-            </script>
-        </div>
-            '''
-            await websocket.send_text(script_html)
-        
+            await emitter.finish_reasoning(reasoning_id)
+
         return final_answer_text
 
     except Exception as e:
-        error_html = f'<div hx-swap-oob="beforeend:#{content_id}" class="text-sm text-red-500">[Error]: {e}</div>'
-        await websocket.send_text(error_html)
+        await emitter.error(content_id, f"[Error]: {e}")
         return f"An error occurred: {e}"
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=7860)
+    # Browsers offer permessage-deflate on every websocket and uvicorn accepts
+    # it by default, so both wire formats are compressed however the app is
+    # served (`uvicorn src.app:app`, `fastapi run`). The flag below only
+    # restates that default; turning it off in the server turns compression off.
+    uvicorn.run(app, host="0.0.0.0", port=7860, ws="websockets", ws_per_message_deflate=True)
             
@@ -0,0 +1,269 @@
+"""
+Batch agent runs: a JSONL file of prompts pushed through the same agent loop
+as the websocket, several at a time, without a client attached.
+
+Each job lives in tmp/batch/<job_id>/ (`input.jsonl` and `results.jsonl`).
+Results are appended as items finish, so restarting a job with the same ID
+skips every item that already succeeded and retries the ones that failed.
+"""
+import os
+import json
+import time
+import asyncio
+from typing import Dict, Any, List, Optional, Callable, Awaitable, AsyncGenerator
+
+from .config import env_float
+from .chat_template import drop_prompt_cache
+from .sandbox_manager import close_sandbox
+from .session_store import get_session_store, SESSION_DB_PATH
+
+BATCH_DIR = "tmp/batch"
+# Uploads land directly in tmp/ and move to tmp/<response_id>/ once a chat
+# uses them; batch items may only reference files in those two places.
+BATCH_FILES_DIR = "tmp"
+# Files directly in tmp/ that are not uploads.
+_STORE_SUFFIXES = ("", "-journal", "-wal", "-shm")
+BATCH_CONCURRENCY = int(env_float("UFD_BATCH_CONCURRENCY", 4))
+BATCH_MAX_CONCURRENCY = int(env_float("UFD_BATCH_MAX_CONCURRENCY", 16))
+
+# Runs one item in the given sandbox session and returns its result fields.
+ItemRunner = Callable[[Dict[str, Any], str], Awaitable[Dict[str, Any]]]
+
+# Jobs running in this process, by job ID.
+_jobs: Dict[str, "BatchJob"] = {}
+
+
+def parse_items(text: str) -> List[Dict[str, Any]]:
+    """
+    Parses a JSONL job. Each line is an object with a `prompt`, and optionally
+    an `id`, `files` (paths of uploaded files) and `max_iterations`. Items
+    without an ID are numbered by line. Raises ValueError on a bad line.
+    """
+    items, seen = [], set()
+    for number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Line {number} is not valid JSON: {e}")
+        if not isinstance(item, dict) or not isinstance(item.get("prompt"), str):
+            raise ValueError(f"Line {number} must be an object with a string 'prompt'.")
+        item["id"] = str(item.get("id", number))
+        if item["id"] in seen:
+            raise ValueError(f"Line {number} repeats item id {item['id']!r}.")
+        seen.add(item["id"])
+        files = item.get("files", [])
+        if not isinstance(files, list) or not all(isinstance(path, str) for path in files):
+            raise ValueError(f"Line {number}: 'files' must be a list of paths.")
+        items.append(item)
+    return items
+
+
+def _is_upload(real_path: str) -> bool:
+    root = os.path.realpath(BATCH_FILES_DIR)
+    if os.path.commonpath([root, real_path]) != root:
+        return False
+    parts = os.path.relpath(real_path, root).split(os.sep)
+    if len(parts) == 1:
+        store = os.path.realpath(SESSION_DB_PATH)
+        return real_path not in {store + suffix for suffix in _STORE_SUFFIXES}
+    # Response directories are numeric, which also rules out tmp/batch/.
+    return len(parts) == 2 and parts[0].isdigit()
+
+
+def resolve_item_files(paths: List[str]) -> List[Dict[str, Any]]:
+    """ Loads an item's files as session files, refusing anything that is not an uploaded file. """
+    files = []
+    for path in paths:
+        real_path = os.path.realpath(path)
+        if not _is_upload(real_path) or not os.path.isfile(real_path):
+            raise ValueError(f"File {path!r} was not found among the uploaded files.")
+        with open(real_path, "rb") as f:
+            files.append({"path": os.path.basename(real_path), "data": f.read(), "local_path": path})
+    return files
+
+
+def job_dir(job_id: str) -> str:
+    if not job_id or not all(c.isalnum() or c in "-_" for c in job_id):
+        raise ValueError("Job IDs may only contain letters, digits, '-' and '_'.")
+    return os.path.join(BATCH_DIR, job_id)
+
+
+def load_job_items(job_id: str) -> Optional[List[Dict[str, Any]]]:
+    """ The stored input of an earlier job, or None if there is no such job. """
+    path = os.path.join(job_dir(job_id), "input.jsonl")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return parse_items(f.read())
+
+
+def _succeeded_ids(results_path: str) -> set:
+    """ Items whose latest result is a success; earlier lines are superseded by later ones. """
+    latest = {}
+    if os.path.exists(results_path):
+        with open(results_path) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                    latest[result["id"]] = result["status"]
+                except (json.JSONDecodeError, KeyError):
+                    # A line cut short by a crash; that item simply runs again.
+                    continue
+    return {item_id for item_id, status in latest.items() if status == "ok"}
+
+
+class BatchJob:
+    """
+    Runs a job's pending items with `concurrency` slots. Each slot owns one
+    sandbox session for the whole job, so sandboxes are created once per slot
+    rather than once per item, and one slot's code never shares a kernel with
+    another's.
+    """
+
+    def __init__(self, job_id: str, items: List[Dict[str, Any]], concurrency: int, run_item: ItemRunner):
+        self.job_id = job_id
+        self.dir = job_dir(job_id)
+        self.results_path = results_path(job_id)
+        self.concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+        self.run_item = run_item
+        self.total = len(items)
+
+        os.makedirs(self.dir, exist_ok=True)
+        with open(os.path.join(self.dir, "input.jsonl"), "w") as f:
+            f.writelines(json.dumps(item, ensure_ascii=False) + "\n" for item in items)
+        done = _succeeded_ids(self.results_path)
+        self.skipped = len(done)
+        self.pending = [item for item in items if item["id"] not in done]
+        self.completed = 0
+        self.failed = 0
+        self.started_at = time.time()
+        self.listeners: List[asyncio.Queue] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> asyncio.Task:
+        self.task = asyncio.create_task(self._run())
+        return self.task
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "total": self.total,
+            "skipped": self.skipped,
+            "completed": self.completed,
+            "failed": self.failed,
+            "remaining": self.total - self.skipped - self.completed,
+            "concurrency": self.concurrency,
+            "running": self.task is not None and not self.task.done(),
+        }
+
+    async def _run(self):
+        print(f"--- Batch {self.job_id}: {len(self.pending)} items to run, {self.skipped} already done, "
+              f"{self.concurrency} slots ---")
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in self.pending:
+            queue.put_nowait(item)
+        slots = [f"batch-{self.job_id}-{slot}" for slot in range(min(self.concurrency, len(self.pending)))]
+        try:
+            await asyncio.gather(*(self._slot(queue, session_id) for session_id in slots))
+        finally:
+            for session_id in slots:
+                drop_prompt_cache(session_id)
+                await asyncio.to_thread(self._close_slot, session_id)
+            for listener in self.listeners:
+                listener.put_nowait(None)
+            print(f"--- Batch {self.job_id} finished: {self.status()} ---")
+
+    @staticmethod
+    def _close_slot(session_id: str):
+        store = get_session_store()
+        if (store.get(session_id) or {}).get("sandbox_id"):
+            close_sandbox(session_id)
+        store.delete(session_id)
+
+    async def _slot(self, queue: asyncio.Queue, session_id: str):
+        while not queue.empty():
+            item = queue.get_nowait()
+            started = time.monotonic()
+            queued_ms = round((time.time() - self.started_at) * 1000, 1)
+            try:
+                fields = await self.run_item(item, session_id)
+                result = {"id": item["id"], "status": "error" if fields.get("errors") else "ok", **fields}
+            except Exception as e:
+                result = {"id": item["id"], "status": "error", "errors": [str(e)]}
+            result.setdefault("timings", {})
+            result["timings"].update({
+                "queued_ms": queued_ms,
+                "total_ms": round((time.monotonic() - started) * 1000, 1),
+            })
+            self._record(result)
+
+    def _record(self, result: Dict[str, Any]):
+        self.completed += 1
+        if result["status"] != "ok":
+            self.failed += 1
+        line = json.dumps(result, ensure_ascii=False) + "\n"
+        with open(self.results_path, "a") as f:
+            f.write(line)
+        for listener in self.listeners:
+            listener.put_nowait(line)
+
+    def subscribe(self) -> asyncio.Queue:
+        """ A queue that receives each result line from now on, then None when the job ends. """
+        listener: asyncio.Queue = asyncio.Queue()
+        if self.task is None or self.task.done():
+            listener.put_nowait(None)
+        else:
+            self.listeners.append(listener)
+        return listener
+
+    async def follow(self, listener: asyncio.Queue) -> AsyncGenerator[str, None]:
+        """
+        Streams a subscription. A client that disconnects only stops its own
+        stream; the job keeps running and its results still reach the file.
+        """
+        try:
+            while (line := await listener.get()) is not None:
+                yield line
+        finally:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+
+def get_job(job_id: str) -> Optional[BatchJob]:
+    return _jobs.get(job_id)
+
+
+def job_status(job_id: str) -> Optional[Dict[str, Any]]:
+    """ Progress of a job, whether it is running here or only exists on disk. """
+    if job := _jobs.get(job_id):
+        return job.status()
+    items = load_job_items(job_id)
+    if items is None:
+        return None
+    succeeded = _succeeded_ids(results_path(job_id))
+    return {"job_id": job_id, "total": len(items), "succeeded": len(succeeded),
+            "remaining": len(items) - len(succeeded), "running": False}
+
+
+def results_path(job_id: str) -> str:
+    return os.path.join(job_dir(job_id), "results.jsonl")
+
+
+def start_job(job_id: str, items: List[Dict[str, Any]], concurrency: int, run_item: ItemRunner) -> BatchJob:
+    """ Starts (or resumes) a job. Raises RuntimeError if it is already running here. """
+    if (job := _jobs.get(job_id)) and not job.task.done():
+        raise RuntimeError(f"Batch job {job_id} is already running.")
+    job = BatchJob(job_id, items, concurrency, run_item)
+    _jobs[job_id] = job
+    job.start()
+    return job
+
+
+async def cancel_batch_jobs():
+    """ Stops running jobs; whatever finished is already on disk for a later resume. """
+    running = [job.task for job in _jobs.values() if job.task and not job.task.done()]
+    for task in running:
+        task.cancel()
+    await asyncio.gather(*running, return_exceptions=True)
@@ -0,0 +1,51 @@
+"""
+Measures how long a cold `import src.app` takes and which modules dominate it.
+
+    python -m src.bench_import [--runs N] [--top N]
+
+Each run is a fresh interpreter started with `-X importtime`, so nothing is
+cached between runs.
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+def run_once():
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import src.app"],
+        capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise SystemExit(proc.stderr)
+    # Lines look like: "import time:   self [us] |  cumulative | imported package"
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, self_us, cumulative_us, name = [part.strip() for part in line.replace("import time:", "|", 1).split("|")]
+        modules.append((int(cumulative_us), int(self_us), name))
+    return wall, modules
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    walls = []
+    modules = []
+    for _ in range(args.runs):
+        wall, modules = run_once()
+        walls.append(wall)
+
+    walls.sort()
+    print(f"import src.app: best {walls[0] * 1000:.1f} ms, median {walls[len(walls) // 2] * 1000:.1f} ms over {args.runs} runs")
+    print(f"\nTop {args.top} imports by cumulative time (last run):")
+    for cumulative_us, self_us, name in sorted(modules, reverse=True)[:args.top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {self_us / 1000:8.1f} ms self  {name}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+import os
+import re
+import json
+import hashlib
+import functools
+from typing import Dict, Any, List, Optional, Tuple
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
+
+# Qwen-Agent style function-call markers, also accepted when parsing raw output.
+FN_NAME = '✿FUNCTION✿'
+FN_ARGS = '✿ARGS✿'
+FN_RESULT = '✿RESULT✿'
+FN_EXIT = '✿RETURN✿'
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+TOOL_CALL_OPEN = "<tool_call>"
+TOOL_CALL_CLOSE = "</tool_call>"
+
+# Chat template shipped in src/static for each model; UFD_CHAT_TEMPLATE overrides it.
+MODEL_TEMPLATES = {
+    "qwen3-0.6B": "chat.j2",
+}
+DEFAULT_TEMPLATE = "chat.j2"
+
+# Optional local tokenizer (a Hugging Face tokenizer.json). Without it, tokens
+# are counted by llama-server's /tokenize endpoint.
+TOKENIZER_PATH = os.environ.get("UFD_TOKENIZER_PATH")
+
+# A string that never occurs in real messages, used to locate template output.
+_SENTINEL = "\x00UFD\x00"
+
+XML_FUNCTION_PATTERN = re.compile(r"<function=([^>\n]+)>(.*?)</function>", re.DOTALL)
+XML_PARAMETER_PATTERN = re.compile(r"<parameter=([^>\n]+)>\n?(.*?)\n?</parameter>", re.DOTALL)
+FN_MARKER_PATTERN = re.compile(
+    re.escape(FN_NAME) + r":?\s*(.+?)\s*\n\s*" + re.escape(FN_ARGS) + r":?\s*(.*?)(?=" + "|".join(
+        re.escape(m) for m in (FN_NAME, FN_RESULT, FN_EXIT)
+    ) + r"|$)",
+    re.DOTALL,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _environment():
+    # Same settings Hugging Face uses for chat templates, so our rendering
+    # matches what llama-server would produce from the same file.
+    from jinja2 import FileSystemLoader
+    from jinja2.sandbox import ImmutableSandboxedEnvironment
+
+    def raise_exception(message):
+        raise ValueError(message)
+
+    env = ImmutableSandboxedEnvironment(
+        loader=FileSystemLoader(STATIC_DIR),
+        trim_blocks=True,
+        lstrip_blocks=True,
+    )
+    env.filters["tojson"] = lambda value, indent=None: json.dumps(value, ensure_ascii=False, indent=indent)
+    env.globals["raise_exception"] = raise_exception
+    return env
+
+
+def template_for_model(model_name: str) -> str:
+    return os.environ.get("UFD_CHAT_TEMPLATE") or MODEL_TEMPLATES.get(model_name, DEFAULT_TEMPLATE)
+
+
+@functools.lru_cache(maxsize=None)
+def get_chat_template(name: str) -> "ChatTemplate":
+    """ Compiles a template from src/static once per process. """
+    return ChatTemplate(name)
+
+
+class ChatTemplate:
+    """
+    A compiled chat template plus the pieces needed to extend a prompt without
+    re-rendering it: the generation prompt and the end-of-turn suffix.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        env = _environment()
+        self.template = env.get_template(name)
+        # How this template asks the model to format tool calls.
+        source = env.loader.get_source(env, name)[0]
+        self.tool_format = "xml" if "<function=" in source else "hermes"
+        probe = [{"role": "user", "content": _SENTINEL}]
+        base = self.render(probe)
+        self.generation_prompt = self.render(probe, add_generation_prompt=True)[len(base):]
+        answered = self.render(probe + [{"role": "assistant", "content": _SENTINEL}])[len(base):]
+        self.end_of_turn = answered[answered.index(_SENTINEL) + len(_SENTINEL):]
+
+    def render(self, messages: List[Dict[str, Any]], tools: Optional[List[Dict]] = None,
+               add_generation_prompt: bool = False) -> str:
+        context = {"messages": messages, "add_generation_prompt": add_generation_prompt}
+        if tools:
+            context["tools"] = tools
+        return self.template.render(**context)
+
+    def render_segment(self, messages: List[Dict[str, Any]]) -> Optional[str]:
+        """
+        Renders `messages` as they would appear appended to an existing
+        conversation. Returns None when the template isn't prefix-stable for
+        them, in which case the caller must re-render the whole prompt.
+        """
+        anchor = [{"role": "assistant", "content": _SENTINEL}]
+        base = self.render(anchor)
+        full = self.render(anchor + _normalise_messages(messages))
+        if not full.startswith(base):
+            return None
+        return full[len(base):]
+
+
+def _flatten_content(content: Any) -> Any:
+    """ Joins OpenAI-style content parts into one string; our text parts carry their own separators. """
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return content
+
+
+def _normalise_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Templates concatenate `content` as a string and expect tool-call
+    arguments as mappings, not JSON strings.
+    """
+    normalised = []
+    for message in messages:
+        if isinstance(message.get("content"), list):
+            message = {**message, "content": _flatten_content(message["content"])}
+        if message.get("tool_calls"):
+            calls = []
+            for call in message["tool_calls"]:
+                arguments = call["function"].get("arguments") or "{}"
+                if isinstance(arguments, str):
+                    try:
+                        arguments = json.loads(arguments)
+                    except json.JSONDecodeError:
+                        pass
+                calls.append({**call, "function": {**call["function"], "arguments": arguments}})
+            message = {**message, "tool_calls": calls}
+        normalised.append(message)
+    return normalised
+
+
+def _message_key(message: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(message, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class PromptCache:
+    """
+    The rendered prompt for one session, only ever extended at the end so the
+    bytes llama-server has already cached stay identical between requests.
+
+    `external` tracks the conversation as the app sees it (chat history); the
+    prompt text additionally contains the raw model output and tool results of
+    every agent turn, which the chat history does not keep.
+    """
+
+    def __init__(self, template: ChatTemplate, tools: Optional[List[Dict]] = None):
+        self.template = template
+        self.tools = tools
+        self.segments: List[str] = []
+        self.external: List[str] = []
+        self.token_count = 0
+        self._counted_segments = 0
+        self._generation_prompt_tokens: Optional[int] = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self.segments)
+
+    def prompt(self) -> str:
+        """ The prompt to send for the next generation. """
+        return self.text + self.template.generation_prompt
+
+    def _rebuild(self, messages: List[Dict[str, Any]]):
+        print(f"--- Re-rendering full prompt with {self.template.name} ({len(messages)} messages) ---")
+        self.segments = [self.template.render(_normalise_messages(messages), self.tools)]
+        self.external = [_message_key(m) for m in messages]
+        self.token_count = 0
+        self._counted_segments = 0
+
+    def sync(self, messages: List[Dict[str, Any]]):
+        """ Makes the prompt cover `messages`, appending only what is new. """
+        keys = [_message_key(m) for m in messages]
+        if not self.segments or keys[:len(self.external)] != self.external:
+            self._rebuild(messages)
+            return
+        new_messages = messages[len(self.external):]
+        if new_messages:
+            segment = self.template.render_segment(new_messages)
+            if segment is None:
+                self._rebuild(messages)
+                return
+            self.segments.append(segment)
+            self.external = keys
+
+    def append_messages(self, messages: List[Dict[str, Any]]):
+        """ Appends messages (e.g. tool results) that only the prompt needs to see. """
+        segment = self.template.render_segment(messages)
+        if segment is None:
+            raise ValueError(f"Template {self.template.name} cannot render these messages incrementally.")
+        self.segments.append(segment)
+
+    def append_generation(self, raw_text: str):
+        """ Appends the model's raw output exactly as generated. """
+        self.segments.append(self.template.generation_prompt + raw_text + self.template.end_of_turn)
+
+    def cover(self, message: Dict[str, Any]):
+        """ Records that `message`, added to the chat history, is already in the prompt. """
+        self.external.append(_message_key(message))
+
+    async def count_tokens(self, client_cfg: Dict) -> Optional[int]:
+        """
+        Exact token count of `prompt()`, the text actually sent. Segments and
+        the generation prompt start at a special token, so counting them
+        separately gives the same total as counting the whole string, and only
+        new segments are tokenized. Returns None if the prompt was rebuilt or
+        counted elsewhere while this ran.
+        """
+        segments, start = self.segments, self._counted_segments
+        end = len(segments)
+        if self._generation_prompt_tokens is None:
+            self._generation_prompt_tokens = len(await tokenize(self.template.generation_prompt, client_cfg))
+        counted = 0
+        for segment in segments[start:end]:
+            counted += len(await tokenize(segment, client_cfg))
+        if self.segments is not segments or self._counted_segments != start:
+            return None
+        self.token_count += counted
+        self._counted_segments = end
+        return self.token_count + self._generation_prompt_tokens
+
+
+@functools.lru_cache(maxsize=None)
+def _local_tokenizer():
+    if not TOKENIZER_PATH:
+        return None
+    try:
+        from tokenizers import Tokenizer
+    except ImportError:
+        print("--- UFD_TOKENIZER_PATH is set but `tokenizers` is not installed; using llama-server. ---")
+        return None
+    return Tokenizer.from_file(TOKENIZER_PATH)
+
+
+_http: Dict[str, Any] = {"client": None}
+
+
+def _http_client():
+    """ One pooled client for /tokenize, created on first use. """
+    if _http["client"] is None:
+        import httpx
+        _http["client"] = httpx.AsyncClient(timeout=30)
+    return _http["client"]
+
+
+def token_count_source() -> str:
+    """ Where `tokenize` counts: the local tokenizer.json or llama-server. """
+    return "local tokenizer" if _local_tokenizer() else "llama-server /tokenize"
+
+
+async def close_tokenizer():
+    if _http["client"] is not None:
+        await _http["client"].aclose()
+        _http["client"] = None
+
+
+async def tokenize(text: str, client_cfg: Dict) -> List[int]:
+    if tokenizer := _local_tokenizer():
+        return tokenizer.encode(text, add_special_tokens=False).ids
+    response = await _http_client().post(
+        client_cfg["tokenize_url"],
+        json={"content": text, "add_special": False, "parse_special": True},
+    )
+    response.raise_for_status()
+    return response.json()["tokens"]
+
+
+_prompt_caches: Dict[str, PromptCache] = {}
+
+def get_prompt_cache(session_id: str, model_name: str, tools: Optional[List[Dict]] = None) -> PromptCache:
+    cache = _prompt_caches.get(session_id)
+    template = get_chat_template(template_for_model(model_name))
+    if cache is None or cache.template is not template or cache.tools != tools:
+        cache = _prompt_caches[session_id] = PromptCache(template, tools)
+    return cache
+
+def drop_prompt_cache(session_id: str):
+    _prompt_caches.pop(session_id, None)
+
+
+def _make_call(index: int, name: str, arguments: Any) -> Dict[str, Any]:
+    if not isinstance(arguments, str):
+        arguments = json.dumps(arguments, ensure_ascii=False)
+    return {"id": f"call_{index}", "type": "function", "function": {"name": name.strip(), "arguments": arguments}}
+
+
+def parse_tool_calls(text: str) -> List[Dict[str, Any]]:
+    """
+    Parses tool calls out of raw model output into OpenAI-style `tool_calls`.
+    Understands the three formats our templates and prompts ask for:
+    `<tool_call>{json}</tool_call>`, `<tool_call><function=...>` (XML
+    parameters) and the ✿FUNCTION✿/✿ARGS✿ markers.
+    """
+    calls = []
+    for block in text.split(TOOL_CALL_OPEN)[1:]:
+        body = block.split(TOOL_CALL_CLOSE, 1)[0].strip()
+        if body.startswith("{"):
+            try:
+                parsed = json.loads(body)
+                calls.append(_make_call(len(calls), parsed["name"], parsed.get("arguments", {})))
+            except (json.JSONDecodeError, KeyError, TypeError):
+                # Keep malformed arguments so the caller's validation sees them.
+                name = re.search(r'"name"\s*:\s*"([^"]+)"', body)
+                if name:
+                    calls.append(_make_call(len(calls), name.group(1), body))
+        for match in XML_FUNCTION_PATTERN.finditer(body):
+            arguments = {k.strip(): v for k, v in XML_PARAMETER_PATTERN.findall(match.group(2))}
+            calls.append(_make_call(len(calls), match.group(1), arguments))
+    for match in FN_MARKER_PATTERN.finditer(text):
+        calls.append(_make_call(len(calls), match.group(1), match.group(2).strip()))
+    return calls
+
+
+def _partial_marker_length(text: str, markers: Tuple[str, ...]) -> int:
+    """ Length of the longest suffix of `text` that could be the start of a marker. """
+    longest = 0
+    for marker in markers:
+        for size in range(min(len(marker) - 1, len(text)), 0, -1):
+            if text.endswith(marker[:size]):
+                longest = max(longest, size)
+                break
+    return longest
+
+
+class RawOutputParser:
+    """
+    Splits streamed raw completion text into reasoning and content deltas and
+    holds back tool-call markup, which is parsed once generation ends.
+    """
+
+    CONTENT_MARKERS = (THINK_OPEN, TOOL_CALL_OPEN, FN_NAME)
+
+    def __init__(self):
+        self.raw_text = ""
+        self.saw_tool_markup = False
+        self._pending = ""
+        self._tool_text = ""
+        self._in_think = False
+        self._in_tool = False
+
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        self.raw_text += chunk
+        if self._in_tool:
+            self._tool_text += chunk
+            return []
+        deltas = []
+        pending = self._pending + chunk
+        while pending:
+            if self._in_think:
+                index = pending.find(THINK_CLOSE)
+                if index == -1:
+                    keep = _partial_marker_length(pending, (THINK_CLOSE,))
+                    deltas.append(("reasoning", pending[:len(pending) - keep]))
+                    pending = pending[len(pending) - keep:]
+                    break
+                deltas.append(("reasoning", pending[:index]))
+                pending = pending[index + len(THINK_CLOSE):]
+                self._in_think = False
+                continue
+            found = [(pending.find(m), m) for m in self.CONTENT_MARKERS if m in pending]
+            if not found:
+                keep = _partial_marker_length(pending, self.CONTENT_MARKERS)
+                deltas.append(("content", pending[:len(pending) - keep]))
+                pending = pending[len(pending) - keep:]
+                break
+            index, marker = min(found)
+            deltas.append(("content", pending[:index]))
+            if marker == THINK_OPEN:
+                self._in_think = True
+                pending = pending[index + len(marker):]
+            else:
+                self._in_tool = True
+                self.saw_tool_markup = True
+                self._tool_text = pending[index:]
+                pending = ""
+        self._pending = pending
+        return [(kind, text) for kind, text in deltas if text]
+
+    def finish(self) -> Tuple[List[Tuple[str, str]], List[Dict[str, Any]]]:
+        """ Flushes held-back text and returns (deltas, tool_calls). """
+        deltas = []
+        if self._pending:
+            deltas.append(("reasoning" if self._in_think else "content", self._pending))
+            self._pending = ""
+        tool_calls = parse_tool_calls(self._tool_text) if self._in_tool else []
+        if self._in_tool and not tool_calls:
+            # Looked like a tool call but wasn't one; show it as text.
+            deltas.append(("content", self._tool_text))
+        return deltas, tool_calls
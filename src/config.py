@@ -0,0 +1,46 @@
+import os
+from typing import List
+
+# Numeric settings read from the environment; checked here so a typo is
+# reported at startup instead of raising inside a request.
+NUMERIC_SETTINGS = [
+    "UFD_SESSION_GRACE_SECONDS",
+    "UFD_SESSION_TTL_SECONDS",
+    "UFD_PROFILER_WORKERS",
+    "UFD_PROFILE_MAX_BYTES",
+    "UFD_PROFILE_TIMEOUT_SECONDS",
+    "UFD_PROFILE_CACHE_SIZE",
+    "UFD_SLOW_CALLBACK_MS",
+    "UFD_TOOL_WORKERS",
+    "UFD_BATCH_CONCURRENCY",
+    "UFD_BATCH_MAX_CONCURRENCY",
+    "UFD_TOOL_HTTP_TIMEOUT_SECONDS",
+    "UFD_TOOL_HTTP_MAX_CONNECTIONS",
+]
+
+def env_float(name: str, default: float) -> float:
+    """ Reads a numeric setting, falling back to `default` if it is malformed. """
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+def validate_config() -> List[str]:
+    """
+    Checks the environment without raising, so importing the app never fails
+    on configuration. Returns a list of human-readable problems.
+    """
+    problems = []
+    if not os.environ.get("E2B_API_KEY"):
+        problems.append("E2B_API_KEY is not set; the code interpreter tool will fail when called.")
+    backend = os.environ.get("UFD_SESSION_STORE", "memory")
+    if backend not in ("memory", "sqlite"):
+        problems.append(f"UFD_SESSION_STORE={backend!r} is not one of 'memory' or 'sqlite'.")
+    for name in NUMERIC_SETTINGS:
+        value = os.environ.get(name)
+        if value is not None:
+            try:
+                float(value)
+            except ValueError:
+                problems.append(f"{name}={value!r} is not a number.")
+    return problems
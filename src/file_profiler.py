@@ -0,0 +1,284 @@
+import io
+import os
+import csv
+import json
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, List, Optional
+
+from .config import env_float
+
+PROFILER_WORKERS = max(1, int(env_float("UFD_PROFILER_WORKERS", 2)))
+# Files above this size are not profiled; the agent can still inspect them itself.
+PROFILE_MAX_BYTES = int(env_float("UFD_PROFILE_MAX_BYTES", 200 * 1024 * 1024))
+# How long a turn waits for a profile that is still running before going without it.
+PROFILE_TIMEOUT_SECONDS = env_float("UFD_PROFILE_TIMEOUT_SECONDS", 5)
+# Finished profiles kept for reuse; in-flight ones are never evicted.
+PROFILE_CACHE_SIZE = max(1, int(env_float("UFD_PROFILE_CACHE_SIZE", 256)))
+# Uploads whose digest is remembered until a turn picks them up.
+MAX_PENDING_UPLOADS = 1024
+
+SAMPLE_ROWS = 3
+MAX_COLUMNS = 30
+MAX_VALUE_CHARS = 40
+
+FORMATS = {
+    ".csv": "csv",
+    ".tsv": "csv",
+    ".parquet": "parquet",
+    ".json": "json",
+    ".jsonl": "json",
+    ".xlsx": "excel",
+    ".xls": "excel",
+}
+
+_executor: Optional[ProcessPoolExecutor] = None
+# Finished and in-flight profiles, keyed by the SHA-256 of the file contents,
+# least recently used first.
+_profiles: "OrderedDict[str, asyncio.Future[Optional[Dict[str, Any]]]]" = OrderedDict()
+# Digest of each upload path, so a turn doesn't hash the file a second time.
+_upload_digests: "OrderedDict[str, str]" = OrderedDict()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PROFILER_WORKERS)
+    return _executor
+
+
+def shutdown_profiler():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _reset_broken_pool():
+    """ A pool whose worker died stays broken; drop it so the next profile starts a fresh one. """
+    print("[Profiler] Worker process died; restarting the profiler pool.")
+    shutdown_profiler()
+    for digest, future in list(_profiles.items()):
+        if future.done() and not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            del _profiles[digest]
+
+
+def file_format(filename: str) -> Optional[str]:
+    return FORMATS.get(os.path.splitext(filename)[1].lower())
+
+
+def _short(value: Any) -> str:
+    text = str(value)
+    return text if len(text) <= MAX_VALUE_CHARS else text[:MAX_VALUE_CHARS - 3] + "..."
+
+
+def _profile_with_pandas(filename: str, data: bytes, fmt: str) -> Dict[str, Any]:
+    import pandas as pd
+
+    buffer = io.BytesIO(data)
+    if fmt == "csv":
+        df = pd.read_csv(buffer, sep="\t" if filename.lower().endswith(".tsv") else ",")
+    elif fmt == "parquet":
+        df = pd.read_parquet(buffer)
+    elif fmt == "excel":
+        df = pd.read_excel(buffer)
+    else:
+        df = pd.read_json(buffer, lines=filename.lower().endswith(".jsonl"))
+
+    columns = [
+        {"name": str(name), "dtype": str(df[name].dtype), "nulls": int(df[name].isna().sum())}
+        for name in df.columns
+    ]
+    stats = {}
+    numeric = df.select_dtypes("number")
+    if not numeric.empty:
+        described = numeric.describe().T
+        for name, row in described.iterrows():
+            stats[str(name)] = {key: float(row[key]) for key in ("min", "max", "mean")}
+    return {
+        "format": fmt,
+        "rows": int(len(df)),
+        "columns": columns,
+        "stats": stats,
+        "sample": df.head(SAMPLE_ROWS).astype(str).to_dict(orient="records"),
+    }
+
+
+def _profile_records(fmt: str, header: List[str], rows: List[List[Any]]) -> Dict[str, Any]:
+    """ Stdlib fallback: infers int/float/str per column and numeric min/max/mean. """
+    columns, stats = [], {}
+    for index, name in enumerate(header):
+        values = [row[index] if index < len(row) else None for row in rows]
+        present = [v for v in values if v not in (None, "")]
+        numbers = []
+        for value in present:
+            try:
+                numbers.append(float(value))
+            except (TypeError, ValueError):
+                numbers = None
+                break
+        if numbers:
+            dtype = "int" if all(n.is_integer() for n in numbers) else "float"
+            stats[name] = {"min": min(numbers), "max": max(numbers), "mean": sum(numbers) / len(numbers)}
+        else:
+            dtype = "str"
+        columns.append({"name": name, "dtype": dtype, "nulls": len(values) - len(present)})
+    return {
+        "format": fmt,
+        "rows": len(rows),
+        "columns": columns,
+        "stats": stats,
+        "sample": [dict(zip(header, map(str, row))) for row in rows[:SAMPLE_ROWS]],
+    }
+
+
+def _profile_with_stdlib(filename: str, data: bytes, fmt: str) -> Optional[Dict[str, Any]]:
+    text = data.decode("utf-8", errors="replace")
+    if fmt == "csv":
+        reader = csv.reader(io.StringIO(text), delimiter="\t" if filename.lower().endswith(".tsv") else ",")
+        rows = list(reader)
+        if not rows:
+            return None
+        return _profile_records(fmt, rows[0], rows[1:])
+    if fmt == "json":
+        if filename.lower().endswith(".jsonl"):
+            records = [json.loads(line) for line in text.splitlines() if line.strip()]
+        else:
+            records = json.loads(text)
+        if not isinstance(records, list) or not records or not isinstance(records[0], dict):
+            return None
+        header = list(records[0].keys())
+        return _profile_records(fmt, header, [[record.get(key) for key in header] for record in records])
+    # Parquet and Excel need pandas.
+    return None
+
+
+def profile_bytes(filename: str, data: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Computes schema, row count, sample rows and basic numeric stats for a
+    tabular file. Runs in a worker process. Returns None for unsupported or
+    unreadable files.
+    """
+    fmt = file_format(filename)
+    if fmt is None:
+        return None
+    try:
+        try:
+            return _profile_with_pandas(filename, data, fmt)
+        except ImportError:
+            return _profile_with_stdlib(filename, data, fmt)
+    except Exception as e:
+        print(f"[Profiler] Could not profile {filename}: {e}")
+        return None
+
+
+def _eligible(filename: str, data: bytes) -> bool:
+    return file_format(filename) is not None and len(data) <= PROFILE_MAX_BYTES
+
+
+def _evict():
+    """ Drops the least recently used finished profiles beyond PROFILE_CACHE_SIZE. """
+    finished = [digest for digest, future in _profiles.items() if future.done()]
+    for digest in finished[:max(0, len(finished) - PROFILE_CACHE_SIZE)]:
+        del _profiles[digest]
+
+
+def _start(filename: str, data: bytes, digest: str) -> bool:
+    """ Starts profiling unless `digest` is already profiled or in flight. Returns False if it can't start. """
+    if digest in _profiles:
+        _profiles.move_to_end(digest)
+        _evict()
+        return True
+    loop = asyncio.get_running_loop()
+    try:
+        try:
+            _profiles[digest] = loop.run_in_executor(_get_executor(), profile_bytes, filename, data)
+        except BrokenProcessPool:
+            _reset_broken_pool()
+            _profiles[digest] = loop.run_in_executor(_get_executor(), profile_bytes, filename, data)
+    except Exception as e:
+        print(f"[Profiler] Could not start profiling {filename}: {e}")
+        return False
+    _evict()
+    return True
+
+
+async def schedule_profile(filename: str, data: bytes, upload_path: Optional[str] = None) -> Optional[str]:
+    """
+    Starts profiling `data` in the process pool unless an identical file is
+    already profiled or in flight. The file is hashed in a thread, once: with
+    `upload_path`, the digest is remembered for `get_profile` on that path.
+    Returns the content hash, or None if the file isn't eligible or profiling
+    can't start; profiling never fails the caller.
+    """
+    if not _eligible(filename, data):
+        return None
+    digest = await asyncio.to_thread(lambda: hashlib.sha256(data).hexdigest())
+    if not _start(filename, data, digest):
+        return None
+    if upload_path is not None:
+        _upload_digests[upload_path] = digest
+        _upload_digests.move_to_end(upload_path)
+        while len(_upload_digests) > MAX_PENDING_UPLOADS:
+            _upload_digests.popitem(last=False)
+    return digest
+
+
+async def get_profile(filename: str, data: bytes, timeout: float = PROFILE_TIMEOUT_SECONDS,
+                      upload_path: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Returns the profile for a file, waiting at most `timeout` seconds for it.
+    Pass the `upload_path` given to `schedule_profile` to reuse its digest.
+    """
+    digest = _upload_digests.pop(upload_path, None) if upload_path is not None else None
+    if digest is None:
+        digest = await schedule_profile(filename, data)
+    elif not _eligible(filename, data) or not _start(filename, data, digest):
+        digest = None
+    if digest is None:
+        return None
+    try:
+        return await asyncio.wait_for(asyncio.shield(_profiles[digest]), timeout)
+    except asyncio.TimeoutError:
+        print(f"[Profiler] Profile for {filename} not ready after {timeout}s; continuing without it.")
+        return None
+    except BrokenProcessPool:
+        _reset_broken_pool()
+        _profiles.pop(digest, None)
+        return None
+    except Exception as e:
+        print(f"[Profiler] Profiling {filename} failed: {e}")
+        _profiles.pop(digest, None)
+        return None
+
+
+def format_profile(filename: str, profile: Dict[str, Any]) -> str:
+    """ Renders a profile as the compact summary injected into the user message. """
+    columns = profile["columns"]
+    lines = [f"'{filename}' ({profile['format']}, {profile['rows']} rows x {len(columns)} columns)"]
+
+    described = []
+    for column in columns[:MAX_COLUMNS]:
+        detail = column["dtype"]
+        if column["nulls"]:
+            detail += f", {column['nulls']} nulls"
+        described.append(f"{column['name']} ({detail})")
+    if len(columns) > MAX_COLUMNS:
+        described.append(f"... {len(columns) - MAX_COLUMNS} more")
+    lines.append("Columns: " + ", ".join(described))
+
+    if profile["stats"]:
+        stats = [
+            f"{name} min={s['min']:g} max={s['max']:g} mean={s['mean']:g}"
+            for name, s in list(profile["stats"].items())[:MAX_COLUMNS]
+        ]
+        lines.append("Numeric: " + "; ".join(stats))
+
+    if profile["sample"]:
+        lines.append("Sample rows:")
+        for row in profile["sample"]:
+            lines.append("  " + json.dumps({k: _short(v) for k, v in list(row.items())[:MAX_COLUMNS]}, ensure_ascii=False))
+    return "\n".join(lines)
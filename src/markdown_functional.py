@@ -1,17 +1,33 @@
 import re
 from typing import Tuple
-import markdown_it
-
-# Initialize the markdown-it parser once to be reused.
-md = markdown_it.MarkdownIt(
-    "commonmark",
-    {
-        "html": True,       # Allow HTML tags in source
-        "xhtmlout": False,  # Don't create XHTML-compliant tags
-        "breaks": True,     # Convert '\n' in paragraphs into <br>
-        "linkify": True,    # Autoconvert URL-like text to links
-    }
-).enable("table")
+
+# The markdown-it parser is built on first use and then reused, so importing
+# this module doesn't pay for markdown_it.
+_md = None
+
+def get_md():
+    global _md
+    if _md is None:
+        import markdown_it
+        _md = markdown_it.MarkdownIt(
+            "commonmark",
+            {
+                "html": True,       # Allow HTML tags in source
+                "xhtmlout": False,  # Don't create XHTML-compliant tags
+                "breaks": True,     # Convert '\n' in paragraphs into <br>
+                "linkify": True,    # Autoconvert URL-like text to links
+            }
+        ).enable("table")
+    return _md
+
+def render_markdown(text: str) -> str:
+    return get_md().render(text)
+
+def __getattr__(name):
+    # Keeps `markdown_functional.md` working for existing callers.
+    if name == "md":
+        return get_md()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Regex to detect an opening code fence (e.g., ```python)
 OPEN_FENCE_PATTERN = re.compile(r"^\s*`{3,}[\w-]*\s*$", re.MULTILINE)
@@ -0,0 +1,239 @@
+"""
+Admin-only diagnostics for event-loop stalls and hot paths.
+
+Everything here is off unless UFD_PROFILING=1: the router isn't mounted, no
+heartbeat or watchdog runs, and `session_lag` is a no-op context manager.
+Requests must carry UFD_ADMIN_TOKEN in the `X-Admin-Token` header.
+"""
+import os
+import sys
+import hmac
+import time
+import asyncio
+import threading
+import traceback
+import contextlib
+from collections import Counter, deque
+from typing import Dict, Any, Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from .config import env_float
+from .tool_grammar import tool_call_stats
+from .tools import tool_metrics
+
+PROFILING_ENABLED = os.environ.get("UFD_PROFILING", "0") == "1"
+ADMIN_TOKEN = os.environ.get("UFD_ADMIN_TOKEN", "")
+# A loop that hasn't run the heartbeat for this long is considered blocked.
+SLOW_CALLBACK_MS = env_float("UFD_SLOW_CALLBACK_MS", 100)
+HEARTBEAT_INTERVAL = 0.05
+MAX_PROFILE_SECONDS = 60
+MAX_SLOW_EVENTS = 50
+
+_state: Dict[str, Any] = {
+    "last_beat": 0.0,
+    "loop_thread_id": None,
+    "heartbeat_task": None,
+    "watchdog": None,
+    "stop": threading.Event(),
+    "slow_events": deque(maxlen=MAX_SLOW_EVENTS),
+    "lag": {"samples": 0, "max_ms": 0.0, "total_ms": 0.0},
+    "sessions": {},
+    "active_sessions": set(),
+}
+
+
+def _record_lag(stats: Dict[str, float], lag_ms: float):
+    stats["samples"] += 1
+    stats["total_ms"] += lag_ms
+    stats["max_ms"] = max(stats["max_ms"], lag_ms)
+    if lag_ms >= SLOW_CALLBACK_MS:
+        stats["slow"] = stats.get("slow", 0) + 1
+
+
+async def _heartbeat():
+    """ Measures how late the loop wakes us up; that delay is the loop lag. """
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + HEARTBEAT_INTERVAL
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        lag_ms = max(0.0, (loop.time() - expected) * 1000)
+        _state["last_beat"] = time.monotonic()
+        _record_lag(_state["lag"], lag_ms)
+        for session_id in _state["active_sessions"]:
+            _record_lag(_state["sessions"].setdefault(session_id, {"samples": 0, "max_ms": 0.0, "total_ms": 0.0}), lag_ms)
+
+
+def _watchdog():
+    """
+    Runs in its own thread. When the heartbeat goes quiet the loop is stuck
+    in a callback, so grab the loop thread's stack while it's still there.
+    """
+    stop = _state["stop"]
+    current_event = None
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        stalled_ms = (time.monotonic() - _state["last_beat"]) * 1000
+        if stalled_ms < SLOW_CALLBACK_MS + HEARTBEAT_INTERVAL * 1000:
+            current_event = None
+            continue
+        if current_event is None:
+            frame = sys._current_frames().get(_state["loop_thread_id"])
+            current_event = {
+                "at": time.time(),
+                "blocked_ms": stalled_ms,
+                "stack": "".join(traceback.format_stack(frame)) if frame else "",
+            }
+            _state["slow_events"].append(current_event)
+        else:
+            current_event["blocked_ms"] = stalled_ms
+
+
+def start_profiling():
+    """ Starts the heartbeat and watchdog. Call from the running event loop. """
+    if not PROFILING_ENABLED:
+        return
+    if not ADMIN_TOKEN:
+        print("--- UFD_PROFILING is on but UFD_ADMIN_TOKEN is unset; admin endpoints will refuse all requests. ---")
+    _state["loop_thread_id"] = threading.get_ident()
+    _state["last_beat"] = time.monotonic()
+    _state["stop"].clear()
+    _state["heartbeat_task"] = asyncio.create_task(_heartbeat())
+    _state["watchdog"] = threading.Thread(target=_watchdog, name="ufd-loop-watchdog", daemon=True)
+    _state["watchdog"].start()
+    print(f"--- Loop profiling enabled (slow callback threshold {SLOW_CALLBACK_MS:g} ms). ---")
+
+
+def stop_profiling():
+    if not PROFILING_ENABLED:
+        return
+    _state["stop"].set()
+    if task := _state["heartbeat_task"]:
+        task.cancel()
+
+
+def session_lag(session_id: str):
+    """ Attributes loop lag to `session_id` while the block runs. """
+    if not PROFILING_ENABLED:
+        return contextlib.nullcontext()
+    return _track_session(session_id)
+
+
+@contextlib.contextmanager
+def _track_session(session_id: str):
+    _state["active_sessions"].add(session_id)
+    try:
+        yield
+    finally:
+        _state["active_sessions"].discard(session_id)
+
+
+def forget_session(session_id: str):
+    _state["sessions"].pop(session_id, None)
+
+
+def _summarise(stats: Dict[str, float]) -> Dict[str, Any]:
+    samples = stats["samples"] or 1
+    return {
+        "samples": stats["samples"],
+        "mean_ms": round(stats["total_ms"] / samples, 2),
+        "max_ms": round(stats["max_ms"], 2),
+        "slow": stats.get("slow", 0),
+    }
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+
+def sample_stacks(seconds: float, hz: float) -> str:
+    """
+    Samples every thread's stack for `seconds` and returns them in collapsed
+    format (`thread;outer;...;inner count` per line), ready for flamegraph.pl
+    or speedscope.
+    """
+    own_thread = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    counts: Counter = Counter()
+    interval = 1.0 / hz
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+def _require_admin(token: Optional[str]):
+    if not ADMIN_TOKEN or not token or not hmac.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required.")
+
+
+router = APIRouter(prefix="/admin")
+
+
+@router.get("/profile", response_class=PlainTextResponse)
+async def profile(seconds: float = 5, hz: float = 100, x_admin_token: Optional[str] = Header(None)):
+    """ On-demand sampling profile; the sampler runs in a thread so the loop keeps serving. """
+    _require_admin(x_admin_token)
+    seconds = min(max(seconds, 0.1), MAX_PROFILE_SECONDS)
+    hz = min(max(hz, 1), 1000)
+    collapsed = await asyncio.to_thread(sample_stacks, seconds, hz)
+    return PlainTextResponse(collapsed, headers={
+        "Content-Disposition": f'attachment; filename="ufd-{int(time.time())}.collapsed"',
+    })
+
+
+@router.get("/tasks")
+async def tasks(x_admin_token: Optional[str] = Header(None)):
+    """ Live dump of every asyncio task and where it is suspended. """
+    _require_admin(x_admin_token)
+    dump = []
+    for task in asyncio.all_tasks():
+        frames = task.get_stack(limit=20)
+        dump.append({
+            "name": task.get_name(),
+            "coro": getattr(task.get_coro(), "__qualname__", repr(task.get_coro())),
+            "done": task.done(),
+            "stack": [_frame_label(frame) for frame in frames],
+        })
+    return {"count": len(dump), "tasks": dump}
+
+
+@router.get("/slow-callbacks")
+async def slow_callbacks(x_admin_token: Optional[str] = Header(None)):
+    """ Recent loop stalls with the stack that was running when each was detected. """
+    _require_admin(x_admin_token)
+    return {"threshold_ms": SLOW_CALLBACK_MS, "events": list(_state["slow_events"])}
+
+
+@router.get("/lag")
+async def lag(x_admin_token: Optional[str] = Header(None)):
+    """ Loop lag overall and per session (sampled while each session had a turn running). """
+    _require_admin(x_admin_token)
+    return {
+        "loop": _summarise(_state["lag"]),
+        "sessions": {sid: _summarise(stats) for sid, stats in _state["sessions"].items()},
+    }
+
+
+@router.get("/tool-calls")
+async def tool_calls(x_admin_token: Optional[str] = Header(None)):
+    """ Malformed tool-call rate per decoding mode (chat, raw, raw+grammar). """
+    _require_admin(x_admin_token)
+    return tool_call_stats()
+
+
+@router.get("/tools")
+async def tools(x_admin_token: Optional[str] = Header(None)):
+    """ Per-tool calls, errors, timeouts, retries and latency. """
+    _require_admin(x_admin_token)
+    return tool_metrics()
@@ -0,0 +1,225 @@
+import json
+import time
+from typing import Optional, List
+from fastapi import WebSocket
+
+# Wire formats for the chat websocket. The client picks one with `?proto=`;
+# HTMX fragments stay the default and the fallback.
+PROTO_HTMX = "htmx"
+PROTO_COMPACT = "compact"
+
+# Compact op codes. Each frame is a JSON array whose first item is the op:
+#   ["k", token]                  session token
+#   ["c"]                         clear the chat before a transcript replay
+#   ["n", kind, id, html]         new bubble; kind is user|reasoning|content|answer
+#   ["t", id, text]               append raw token text to a block
+#   ["r", id, html, tail]         replace a block's rendered HTML, then re-append the unrendered tail
+#   ["s", text]                   tool status line
+#   ["e", id, text]               error, inside block `id` or the chat when id is null
+#   ["f", id]                     reasoning finished; collapse block `id`
+OP_SESSION = "k"
+OP_CLEAR = "c"
+OP_NEW_BUBBLE = "n"
+OP_APPEND_TOKEN = "t"
+OP_REPLACE_BLOCK = "r"
+OP_TOOL_STATUS = "s"
+OP_ERROR = "e"
+OP_FINISH_REASONING = "f"
+
+
+class HtmxEmitter:
+    """
+    Sends each UI update as an `hx-swap-oob` HTML fragment for the htmx ws
+    extension. Content is re-rendered and swapped whenever its stable text grows.
+    """
+
+    streams_tokens = False
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+
+    async def session_token(self, session_id: str):
+        await self.websocket.send_text(f'''
+        <div id="session-token" hx-swap-oob="true" data-session="{session_id}">
+            <script>sessionStorage.setItem('ufd_session', '{session_id}');</script>
+        </div>
+    ''')
+
+    async def clear_chat(self):
+        await self.websocket.send_text('<div hx-swap-oob="innerHTML:#chat-messages"></div>')
+
+    async def user_bubble(self, display_prompt: str):
+        await self.websocket.send_text(f'''
+                <div hx-swap-oob="beforeend:#chat-messages">
+                    <div class="flex justify-end">
+                        <div class="chat-bubble bg-primary text-white p-3 rounded-lg">
+                            {display_prompt}
+                        </div>
+                    </div>
+                </div>
+            ''')
+
+    async def reasoning_bubble(self, reasoning_id: str):
+        await self.websocket.send_text(f'''
+                    <div hx-swap-oob="beforeend:#chat-messages">
+                        <div class="flex justify-start">
+                            <div class="chat-bubble bg-gray-200 text-gray-800 p-3 rounded-xl">
+                                <b>Reasoning:</b>
+                                <div id='{reasoning_id}'></div>
+                            </div>
+                        </div>
+                    </div>
+                ''')
+
+    async def content_bubble(self, content_id: str):
+        await self.websocket.send_text(f'''
+                <div hx-swap-oob="beforeend:#chat-messages">
+                    <div class="flex justify-start">
+                        <div class="chat-bubble bg-gray-200 text-gray-800 p-3 rounded-xl">
+                            <div id='{content_id}'></div>
+                        </div>
+                    </div>
+                </div>
+            ''')
+
+    async def answer_bubble(self, html: str):
+        """ A finished assistant answer, used when replaying a stored transcript. """
+        await self.websocket.send_text(f'''
+                <div hx-swap-oob="beforeend:#chat-messages">
+                    <div class="flex justify-start">
+                        <div class="chat-bubble bg-gray-200 text-gray-800 p-3 rounded-xl">
+                            {html}
+                        </div>
+                    </div>
+                </div>
+            ''')
+
+    async def append_reasoning(self, reasoning_id: str, text: str):
+        await self.websocket.send_text(f'<div hx-swap-oob="beforeend:#{reasoning_id}">{text}</div>')
+
+    async def append_token(self, content_id: str, text: str):
+        pass
+
+    async def replace_block(self, content_id: str, html: str, tail: str = ""):
+        await self.websocket.send_text(f'<div hx-swap-oob="innerHTML:#{content_id}">{html}</div>')
+
+    async def tool_status(self, text: str):
+        await self.websocket.send_text(f'<div hx-swap-oob="beforeend:#chat-messages" class="text-sm text-blue-500"> {text}</div>')
+
+    async def error(self, block_id: Optional[str], text: str):
+        target = f"#{block_id}" if block_id else "#chat-messages"
+        await self.websocket.send_text(f'<div hx-swap-oob="beforeend:{target}" class="text-sm text-red-500">{text}</div>')
+
+    async def finish_reasoning(self, reasoning_id: str):
+        script_container_id = f"script-container-{reasoning_id}"
+        await self.websocket.send_text(f'''
+        <div id={script_container_id} hx-swap-oob="beforeend:#chat-messages">
+            <script>
+                addShowMore("{reasoning_id}");
+                const scriptContainer = document.getElementById('{script_container_id}');
+                if (scriptContainer) {{
+                    scriptContainer.remove();
+                }}
+            </script>
+        </div>
+            ''')
+
+
+class CompactEmitter(HtmxEmitter):
+    """
+    Sends small typed JSON ops keyed by element ID; the applier in index.html
+    owns the markup. Tokens are streamed raw and a block is only re-rendered at
+    markdown block boundaries, so most frames carry just the token text.
+    """
+
+    streams_tokens = True
+
+    async def _send(self, *op):
+        await self.websocket.send_text(json.dumps(op, separators=(",", ":"), ensure_ascii=False))
+
+    async def session_token(self, session_id):
+        await self._send(OP_SESSION, session_id)
+
+    async def clear_chat(self):
+        await self._send(OP_CLEAR)
+
+    async def user_bubble(self, display_prompt):
+        await self._send(OP_NEW_BUBBLE, "user", None, display_prompt)
+
+    async def reasoning_bubble(self, reasoning_id):
+        await self._send(OP_NEW_BUBBLE, "reasoning", reasoning_id, "")
+
+    async def content_bubble(self, content_id):
+        await self._send(OP_NEW_BUBBLE, "content", content_id, "")
+
+    async def answer_bubble(self, html):
+        await self._send(OP_NEW_BUBBLE, "answer", None, html)
+
+    async def append_reasoning(self, reasoning_id, text):
+        await self._send(OP_APPEND_TOKEN, reasoning_id, text)
+
+    async def append_token(self, content_id, text):
+        await self._send(OP_APPEND_TOKEN, content_id, text)
+
+    async def replace_block(self, content_id, html, tail=""):
+        await self._send(OP_REPLACE_BLOCK, content_id, html, tail)
+
+    async def tool_status(self, text):
+        await self._send(OP_TOOL_STATUS, text)
+
+    async def error(self, block_id, text):
+        await self._send(OP_ERROR, block_id, text)
+
+    async def finish_reasoning(self, reasoning_id):
+        await self._send(OP_FINISH_REASONING, reasoning_id)
+
+
+class NullEmitter(HtmxEmitter):
+    """
+    For runs without a client, such as batch jobs. UI updates are dropped;
+    the time of the first token, the tools run and any errors are recorded.
+    """
+
+    streams_tokens = True
+
+    def __init__(self):
+        self.websocket = None
+        self.started_at = time.monotonic()
+        self.first_token_at: Optional[float] = None
+        self.tool_statuses: List[str] = []
+        self.errors: List[str] = []
+
+    async def _ignore(self, *args, **kwargs):
+        pass
+
+    session_token = clear_chat = user_bubble = reasoning_bubble = content_bubble = _ignore
+    answer_bubble = replace_block = finish_reasoning = _ignore
+
+    async def append_reasoning(self, reasoning_id, text):
+        self._first_token()
+
+    async def append_token(self, content_id, text):
+        self._first_token()
+
+    async def tool_status(self, text):
+        self.tool_statuses.append(text)
+
+    async def error(self, block_id, text):
+        self.errors.append(text)
+
+    def _first_token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+
+    @property
+    def first_token_ms(self) -> Optional[float]:
+        if self.first_token_at is None:
+            return None
+        return round((self.first_token_at - self.started_at) * 1000, 1)
+
+
+def get_emitter(websocket: WebSocket) -> HtmxEmitter:
+    """ Chooses the wire format requested by the client, falling back to HTMX. """
+    if websocket.query_params.get("proto") == PROTO_COMPACT:
+        return CompactEmitter(websocket)
+    return HtmxEmitter(websocket)
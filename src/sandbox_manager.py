@@ -1,15 +1,72 @@
-from e2b_code_interpreter import Sandbox
 import os
+import threading
+from .session_store import get_session_store
 
 e2b_key = os.environ.get('E2B_API_KEY')
+# Local handles only; the sandbox ID in the session store is the source of truth
+# so that any worker can reattach to a sandbox another worker created.
 sandboxes = {}
+# One lock per session, so concurrent tool calls of a session attach or create
+# exactly one sandbox while other sessions' sandboxes start in parallel.
+_locks = {}
+_locks_guard = threading.Lock()
 
-def get_sandbox(session_id):
-    if session_id not in sandboxes:
-        sandboxes[session_id] = Sandbox.create(api_key=e2b_key, timeout=1800)
-    return sandboxes[session_id]
+def _sandbox_cls():
+    # e2b is only imported the first time a tool actually needs a sandbox.
+    if not e2b_key:
+        raise RuntimeError("E2B_API_KEY is not set; the code interpreter is unavailable.")
+    from e2b_code_interpreter import Sandbox
+    return Sandbox
+
+def _session_lock(session_id):
+    with _locks_guard:
+        return _locks.setdefault(session_id, threading.Lock())
 
-def close_sandbox(session_id):
+def get_sandbox(session_id):
     if session_id in sandboxes:
-        sandboxes[session_id].kill()
-        del sandboxes[session_id]
+        return sandboxes[session_id]
+    with _session_lock(session_id):
+        if session_id in sandboxes:
+            return sandboxes[session_id]
+        Sandbox = _sandbox_cls()
+        store = get_session_store()
+        state = store.get(session_id) or {}
+        sandbox_id = state.get("sandbox_id")
+        sbx = None
+        if sandbox_id:
+            try:
+                sbx = Sandbox.connect(sandbox_id, api_key=e2b_key)
+                print(f"--- Reattached sandbox {sandbox_id} for session {session_id} ---")
+            except Exception as e:
+                print(f"--- Could not reattach sandbox {sandbox_id}: {e}. Creating a new one. ---")
+        if sbx is None:
+            sbx = Sandbox.create(api_key=e2b_key, timeout=1800)
+            store.update(session_id, sandbox_id=sbx.sandbox_id)
+        sandboxes[session_id] = sbx
+        return sbx
+
+def close_sandbox(session_id, sandbox_id=None):
+    """
+    Kills the session's sandbox: `sandbox_id` if given (e.g. already claimed
+    from the store), otherwise the one recorded in the store.
+    """
+    store = get_session_store()
+    if sandbox_id is None:
+        sandbox_id = (store.get(session_id) or {}).get("sandbox_id")
+    with _locks_guard:
+        _locks.pop(session_id, None)
+    if sbx := sandboxes.pop(session_id, None):
+        sbx.kill()
+    elif sandbox_id:
+        # The sandbox may have been created by another worker.
+        try:
+            _sandbox_cls().kill(sandbox_id, api_key=e2b_key)
+        except Exception as e:
+            print(f"--- Could not kill sandbox {sandbox_id}: {e} ---")
+    # Keep the session itself so its history can still be resumed with a fresh sandbox.
+    if sandbox_id:
+        store.update_if(session_id, {"sandbox_id": sandbox_id}, sandbox_id=None)
+
+def release_sandbox(session_id):
+    """ Drops the local handle without killing the sandbox, e.g. when another worker has reattached. """
+    sandboxes.pop(session_id, None)
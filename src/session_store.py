@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+import contextlib
+from abc import ABC, abstractmethod
+from typing import Dict, Any, List, Optional, Tuple
+
+from .config import env_float
+
+# Selects the backend at startup: "memory" (single process) or "sqlite"
+# (shared by every uvicorn worker on this host).
+SESSION_STORE_BACKEND = os.environ.get("UFD_SESSION_STORE", "memory")
+SESSION_DB_PATH = os.environ.get("UFD_SESSION_DB", "tmp/sessions.db")
+
+# Identifies this process. Used as the sticky-routing hint so a proxy can
+# send a reconnecting client back to the worker holding its live sandbox.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Detached sessions untouched for this long are deleted with their turn log.
+SESSION_TTL_SECONDS = env_float("UFD_SESSION_TTL_SECONDS", 24 * 3600)
+
+
+def new_session_state() -> Dict[str, Any]:
+    """ Returns the empty state stored for a freshly created session. """
+    return {
+        "files": [],
+        "sandbox_id": None,
+        "worker": WORKER_ID,
+        "detached_at": None,
+        "updated_at": time.time(),
+    }
+
+
+class SessionStore(ABC):
+    """
+    Minimal key-value interface for per-session state.
+
+    A session state is a JSON-serialisable dict with the keys produced by
+    `new_session_state`. File manifests only hold names and on-disk paths,
+    never the file bytes, so any worker can reload them from `tmp/`.
+
+    Alongside the small mutable state each session has an append-only turn
+    log, checkpointed after every completed turn. The chat history is
+    rebuilt from it on reconnect, and the transcript replayed from it.
+    """
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def put(self, session_id: str, state: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, session_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def append_turn(self, session_id: str, record: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def get_turns(self, session_id: str) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def _atomic_update(self, session_id: str, expected: Optional[Dict[str, Any]],
+                       fields: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """
+        Reads, checks and writes one session as a single step. Applies
+        `fields` only if every key in `expected` has that value (a missing
+        session counts as a new one). Returns the states before and after the
+        write, or None if the check failed.
+        """
+
+    @abstractmethod
+    def purge_expired(self, ttl_seconds: float) -> int:
+        """ Deletes detached sessions not updated for `ttl_seconds`; returns how many. """
+
+    def update(self, session_id: str, **fields: Any) -> Dict[str, Any]:
+        """ Merges `fields` into the stored state, creating it if needed. """
+        return self._atomic_update(session_id, None, fields)[1]
+
+    def update_if(self, session_id: str, expected: Dict[str, Any], **fields: Any) -> Optional[Dict[str, Any]]:
+        """
+        Compare-and-set: merges `fields` only if the stored values match
+        `expected`. Returns the previous state on success, None otherwise.
+        """
+        result = self._atomic_update(session_id, expected, fields)
+        return result[0] if result else None
+
+
+def _merge(previous: Optional[Dict[str, Any]], expected: Optional[Dict[str, Any]],
+           fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """ The new state for `_atomic_update`, or None if `expected` doesn't match. """
+    state = previous or new_session_state()
+    if expected and any(state.get(key) != value for key, value in expected.items()):
+        return None
+    return {**state, **fields, "updated_at": time.time()}
+
+
+def _expired(state: Dict[str, Any], cutoff: float) -> bool:
+    return state.get("detached_at") is not None and state.get("updated_at", 0) < cutoff
+
+
+class InMemorySessionStore(SessionStore):
+    """ Process-local store. Only correct when running a single worker. """
+
+    def __init__(self):
+        self._sessions: Dict[str, str] = {}
+        self._turns: Dict[str, List[str]] = {}
+        # Tools call into the store from worker threads.
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        raw = self._sessions.get(session_id)
+        return json.loads(raw) if raw is not None else None
+
+    def put(self, session_id, state):
+        # Serialise on write so callers can't mutate the stored copy and so
+        # both backends accept exactly the same data.
+        self._sessions[session_id] = json.dumps(state)
+
+    def delete(self, session_id):
+        self._sessions.pop(session_id, None)
+        self._turns.pop(session_id, None)
+
+    def append_turn(self, session_id, record):
+        self._turns.setdefault(session_id, []).append(json.dumps(record))
+
+    def get_turns(self, session_id):
+        return [json.loads(raw) for raw in self._turns.get(session_id, [])]
+
+    def _atomic_update(self, session_id, expected, fields):
+        with self._lock:
+            previous = self.get(session_id)
+            state = _merge(previous, expected, fields)
+            if state is None:
+                return None
+            self.put(session_id, state)
+            return previous or new_session_state(), state
+
+    def purge_expired(self, ttl_seconds):
+        cutoff = time.time() - ttl_seconds
+        with self._lock:
+            expired = [sid for sid, raw in self._sessions.items() if _expired(json.loads(raw), cutoff)]
+            for session_id in expired:
+                self.delete(session_id)
+        return len(expired)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Host-wide store backed by a SQLite database in WAL mode, which lets many
+    worker processes read concurrently while one writes.
+    """
+
+    def __init__(self, path: str = SESSION_DB_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " session_id TEXT PRIMARY KEY,"
+            " state TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_turns ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " session_id TEXT NOT NULL,"
+            " record TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS session_turns_session ON session_turns (session_id, seq)"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared across threads, and tools run
+        # in `asyncio.to_thread`, so keep one connection per thread.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode: transactions are opened explicitly below.
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        BEGIN IMMEDIATE takes the write lock up front, so a read-modify-write
+        can't interleave with another worker's.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get(self, session_id):
+        row = self._conn().execute(
+            "SELECT state FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, session_id, state):
+        self._write(self._conn(), session_id, state)
+
+    @staticmethod
+    def _write(conn: sqlite3.Connection, session_id: str, state: Dict[str, Any]):
+        conn.execute(
+            "INSERT INTO sessions (session_id, state, updated_at) VALUES (?, ?, ?)"
+            " ON CONFLICT(session_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+            (session_id, json.dumps(state), state.get("updated_at", time.time())),
+        )
+
+    def delete(self, session_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM session_turns WHERE session_id = ?", (session_id,))
+
+    def append_turn(self, session_id, record):
+        self._conn().execute(
+            "INSERT INTO session_turns (session_id, record, created_at) VALUES (?, ?, ?)",
+            (session_id, json.dumps(record), time.time()),
+        )
+
+    def _atomic_update(self, session_id, expected, fields):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT state FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            previous = json.loads(row[0]) if row else None
+            state = _merge(previous, expected, fields)
+            if state is None:
+                return None
+            self._write(conn, session_id, state)
+            return previous or new_session_state(), state
+
+    def purge_expired(self, ttl_seconds):
+        cutoff = time.time() - ttl_seconds
+        with self._transaction() as conn:
+            expired = [
+                session_id for session_id, raw in
+                conn.execute("SELECT session_id, state FROM sessions WHERE updated_at < ?", (cutoff,))
+                if _expired(json.loads(raw), cutoff)
+            ]
+            for session_id in expired:
+                conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                conn.execute("DELETE FROM session_turns WHERE session_id = ?", (session_id,))
+        return len(expired)
+
+    def get_turns(self, session_id):
+        rows = self._conn().execute(
+            "SELECT record FROM session_turns WHERE session_id = ? ORDER BY seq", (session_id,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+
+_store: Optional[SessionStore] = None
+
+def get_session_store() -> SessionStore:
+    """ Returns the process-wide store, creating it on first use. """
+    global _store
+    if _store is None:
+        if SESSION_STORE_BACKEND == "sqlite":
+            _store = SQLiteSessionStore(SESSION_DB_PATH)
+        elif SESSION_STORE_BACKEND == "memory":
+            _store = InMemorySessionStore()
+        else:
+            raise ValueError(f"Unknown UFD_SESSION_STORE backend: {SESSION_STORE_BACKEND!r}")
+    return _store
@@ -0,0 +1,137 @@
+import os
+import re
+import gzip
+import hashlib
+import mimetypes
+from typing import Dict, Any, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
+
+# Text-like assets worth compressing; images such as the favicon are served as-is.
+COMPRESSIBLE_SUFFIXES = {".html", ".css", ".js", ".json", ".svg", ".txt", ".j2"}
+
+# Cache policies. Versioned URLs (`?v=<etag>`) never change, so they can be
+# cached forever; everything else must be revalidated with its ETag.
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+# Matches `/static/<file>` references inside the HTML so they can be versioned.
+STATIC_REF_PATTERN = re.compile(r'(["\'])/static/([\w./-]+)\1')
+
+_assets: Dict[str, Dict[str, Any]] = {}
+
+
+def _brotli_compress(body: bytes) -> Optional[bytes]:
+    """ Brotli is an optional dependency; without it we only offer gzip. """
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli.compress(body, quality=11)
+
+
+def _resolve(rel_path: str) -> Optional[str]:
+    """ Maps a URL path onto a file in STATIC_DIR, refusing anything outside it. """
+    full_path = os.path.normpath(os.path.join(STATIC_DIR, rel_path))
+    if not full_path.startswith(STATIC_DIR + os.sep) or not os.path.isfile(full_path):
+        return None
+    return full_path
+
+
+def _build_asset(rel_path: str, body: bytes) -> Dict[str, Any]:
+    suffix = os.path.splitext(rel_path)[1]
+    media_type = mimetypes.guess_type(rel_path)[0] or "application/octet-stream"
+    if suffix == ".j2":
+        media_type = "text/plain"
+    if media_type.startswith("text/") or media_type == "application/javascript":
+        media_type += "; charset=utf-8"
+
+    encodings = {"identity": body}
+    if suffix in COMPRESSIBLE_SUFFIXES:
+        encodings["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+        if (br := _brotli_compress(body)) is not None:
+            encodings["br"] = br
+
+    version = hashlib.sha256(body).hexdigest()[:16]
+    return {
+        "media_type": media_type,
+        "version": version,
+        "etag": f'"{version}"',
+        "encodings": encodings,
+    }
+
+
+def load_asset(rel_path: str) -> Optional[Dict[str, Any]]:
+    """ Reads, fingerprints and precompresses a static file, caching the result. """
+    if rel_path in _assets:
+        return _assets[rel_path]
+    full_path = _resolve(rel_path)
+    if full_path is None:
+        return None
+    with open(full_path, "rb") as f:
+        body = f.read()
+    if rel_path.endswith(".html"):
+        body = _version_static_refs(body.decode("utf-8")).encode("utf-8")
+    _assets[rel_path] = _build_asset(rel_path, body)
+    return _assets[rel_path]
+
+
+def asset_url(rel_path: str) -> str:
+    """ Returns a content-versioned URL for a static file, or the plain URL if it doesn't exist. """
+    asset = load_asset(rel_path)
+    if asset is None:
+        return f"/static/{rel_path}"
+    return f"/static/{rel_path}?v={asset['version']}"
+
+
+def _version_static_refs(html: str) -> str:
+    return STATIC_REF_PATTERN.sub(
+        lambda m: f"{m.group(1)}{asset_url(m.group(2))}{m.group(1)}", html
+    )
+
+
+def preload_static_assets():
+    """ Precompresses every file in STATIC_DIR so the first request pays no compression cost. """
+    for root, _, filenames in os.walk(STATIC_DIR):
+        for filename in filenames:
+            rel_path = os.path.relpath(os.path.join(root, filename), STATIC_DIR)
+            load_asset(rel_path.replace(os.sep, "/"))
+    print(f"--- Precompressed {len(_assets)} static assets. ---")
+
+
+def _pick_encoding(request: Request, asset: Dict[str, Any]) -> str:
+    accepted = request.headers.get("accept-encoding", "")
+    accepted = {part.split(";")[0].strip() for part in accepted.split(",")}
+    for encoding in ("br", "gzip"):
+        if encoding in accepted and encoding in asset["encodings"]:
+            return encoding
+    return "identity"
+
+
+def asset_response(request: Request, rel_path: str) -> Response:
+    """ Serves a cached asset with content negotiation, ETag revalidation and cache headers. """
+    asset = load_asset(rel_path)
+    if asset is None:
+        return Response(status_code=404)
+
+    # Only a URL carrying the current version is safe to cache forever.
+    immutable = request.query_params.get("v") == asset["version"]
+    headers = {
+        "ETag": asset["etag"],
+        "Cache-Control": IMMUTABLE_CACHE if immutable else REVALIDATE_CACHE,
+        "Vary": "Accept-Encoding",
+    }
+    if asset["etag"] in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    encoding = _pick_encoding(request, asset)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(
+        content=asset["encodings"][encoding],
+        media_type=asset["media_type"],
+        headers=headers,
+    )
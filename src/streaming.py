@@ -1,132 +1,119 @@
-import httpx
+import os
 import json
 import sys
 import asyncio
-from typing import Dict, Any, Callable, List, AsyncGenerator
-from .utils import (get_current_location,
-    get_current_temperature,
-    run_code_interpreter,
-    parse_sbx_exec,
-    create_message_with_files,
-)
+from collections import deque
+from typing import Dict, Any, Callable, Deque, List, AsyncGenerator
+# Importing utils also registers the built-in tools.
+from .utils import create_message_with_files
+from .tools import invoke_tool
+from .chat_template import RawOutputParser
+from .tool_grammar import validate_tool_call, record_tool_call
 MODEL_NAME = "qwen3-0.6B"
 
 client_cfg = {
     "model_name": MODEL_NAME,
     "base_url": "http://localhost:8080/v1/chat/completions",
+    # "chat" sends structured messages; "raw" renders the prompt locally with
+    # the model's chat template and calls llama-server's /completion.
+    "mode": os.environ.get("UFD_COMPLETION_MODE", "chat"),
+    "completion_url": "http://localhost:8080/completion",
+    "tokenize_url": "http://localhost:8080/tokenize",
     "system_prompt": None,
     "api_key": "EMPTY",
 }
 
+# Calls of one session run one at a time and in the order they were queued:
+# they share a kernel, so a later call may depend on an earlier one. While a
+# session has a call running, its later calls wait here instead of holding a
+# worker, so one busy session never stalls the others.
+_session_backlogs: Dict[str, Deque[Dict[str, Any]]] = {}
+
+async def _execute_call(function: Callable, call_data: Dict[str, Any], result_queue: asyncio.Queue):
+    tool_call = json.loads(call_data.get("tool_call"))
+    files = call_data.get("files")
+    session_id = call_data.get("session_id")
+    results = call_data.get("result_queue") or result_queue
+
+    execution_result = None
+    try:
+        print("[Worker] Executing tool call")
+
+        # `function` is async; blocking tools are moved off the loop by the registry.
+        execution_result = await function(tool_call=tool_call,
+                                          files=files,
+                                          session_id=session_id)
+        print(f"EXEC: {execution_result}")
+    except Exception as e:
+        print(f"[Worker] Error during function execution: {e}")
+        # Always answer, so the run waiting on this call isn't left hanging.
+        execution_result = {
+            "role": "tool",
+            "tool_call_id": tool_call.get("id", "missing_id"),
+            "content": f"Error executing tool: {e}",
+            "is_error": True,
+        }
+    finally:
+        if execution_result:
+            await results.put(execution_result)
+
 async def function_worker_async(function: Callable,
     call_queue: asyncio.Queue,
     result_queue: asyncio.Queue
 ):
     """Checks queue for function calls to execute, with corrected error handling.
+
+    Several workers can share one call queue. A call may carry its own
+    `result_queue` so concurrent agent runs each get back only their results;
+    `result_queue` is the fallback for calls that don't. Calls of different
+    sessions run in parallel; calls of the same session run in queue order,
+    all on the worker that took the session's first call.
     """
     while True:
         call_data = await call_queue.get()
         if call_data is None:
             print("[Worker] Sentinel value received. Shutting down.")
             break
-        tool_call = call_data.get("tool_call")
-        tool_call = json.loads(tool_call)
-        files = call_data.get("files")
         session_id = call_data.get("session_id")
-        
-        execution_result = None
+        if session_id is not None:
+            if session_id in _session_backlogs:
+                # The session is busy on another worker, which runs this next.
+                _session_backlogs[session_id].append(call_data)
+                call_queue.task_done()
+                continue
+            _session_backlogs[session_id] = deque()
         try:
-            print("[Worker] Executing tool call")
-            
-            execution_result = await asyncio.to_thread(function,
-                                                        tool_call=tool_call,
-                                                        files=files,
-                                                        session_id=session_id)
-            print(f"EXEC: {execution_result}")
-        except Exception as e:
-            print(f"[Worker] Error during function execution: {e}")
+            while call_data is not None:
+                await _execute_call(function, call_data, result_queue)
+                backlog = _session_backlogs.get(session_id)
+                call_data = backlog.popleft() if backlog else None
         finally:
-            if execution_result:
-                await result_queue.put(execution_result)
+            if session_id is not None:
+                _session_backlogs.pop(session_id, None)
             call_queue.task_done()
 
-def call_function(tool_call: Dict[str, Any],
+async def call_function(tool_call: Dict[str, Any],
     files: List[Dict[str, Any]] = None,
     session_id: str = None,
 ) -> Dict[str, Any]:
-
+    """ Runs one tool call through the tool registry and wraps the result as a tool message. """
     fn_name = tool_call.get("function", {}).get("name", "run_code_interpreter")
     fn_id = tool_call.get("id", "missing_id")  # Get ID early
+    fn_args = tool_call.get("function", {}).get("arguments", "{}")
 
-    try:
-        fn_args_str = tool_call.get("function", {}).get("arguments", "{}")
-        
-        # Handle empty strings and potential double-encoding from the model
-        parsed_args = json.loads(fn_args_str) if fn_args_str.strip() else {}
-
-        # The model sometimes double-encodes the JSON arguments as a string
-        if isinstance(parsed_args, str):
-            fn_args = json.loads(parsed_args)
-        else:
-            fn_args = parsed_args
-
-        # Ensure fn_args is a dictionary before proceeding
-        if not isinstance(fn_args, dict):
-            # This handles cases where the model returns a single value instead of a dict,
-            # e.g., just the code string for run_code_interpreter.
-            fn_args = {"code": fn_args}
-
-        if fn_name == "run_code_interpreter":
-            fn_args['files'] = files
-            fn_args['session_id'] = session_id
-            
-        execution_result_obj = get_function_by_name(fn_name)(**fn_args)
-        parsed_outputs = parse_sbx_exec(execution_result_obj)
-        
-        # Format the parsed outputs into a model-friendly string
-        content_str = ""
-        for output in parsed_outputs:
-            if output['output_type'] == 'stream':
-                content_str += f"Output from {output['name']}:\n{output['text']}\n"
-            elif output['output_type'] == 'execute_result':
-                if 'text/plain' in output['data']:
-                    content_str += f"Result:\n{output['data']['text/plain']}\n"
-            elif output['output_type'] == 'error':
-                content_str += f"An error occurred: {output['ename']}\n{output['evalue']}\n"
-        
-        if not content_str.strip():
-            content_str = "Tool executed successfully with no output."
-        
-        # Check if the tool execution itself resulted in an error
-        tool_had_error = any(out.get('output_type') == 'error' for out in parsed_outputs)
-        
-        response_dict = {
-            "role": "tool",
-            "tool_call_id": fn_id,
-            "content": content_str,
-        }
-        if tool_had_error:
-            response_dict["is_error"] = True
+    content_str, tool_had_error = await invoke_tool(fn_name, fn_args, {"files": files, "session_id": session_id})
+    if tool_had_error:
+        print(f"Error executing tool '{fn_name}' (ID: {fn_id}): {content_str}", file=sys.stderr)
 
-        return response_dict
-    except Exception as e:
-        print(f"Error executing tool '{fn_name}' (ID: {fn_id}): {e}", file=sys.stderr)
-        return {
-            "role": "tool",
-            "tool_call_id": fn_id,
-            "content": f"Error executing tool: {e}",
-            "is_error": True,
-        }
+    response_dict = {
+        "role": "tool",
+        "tool_call_id": fn_id,
+        "content": content_str,
+    }
+    if tool_had_error:
+        response_dict["is_error"] = True
 
-def get_function_by_name(name):
-    if name == "run_code_interpreter":
-        return run_code_interpreter
-    if name == "get_current_temperature":
-        return get_current_temperature
-    if name == "get_current_location":
-        return get_current_location
-    else:
-        return None
+    return response_dict
 
 async def astream_llama_cpp_response(
     messages: List[Dict[str, Any]] = None,
@@ -152,6 +139,8 @@ async def astream_llama_cpp_response(
     
     wip_tool_calls = {}  # Work-in-progress tool calls, keyed by index
 
+    import httpx  # Deferred so importing the app doesn't pay for the HTTP stack.
+
     async with httpx.AsyncClient(timeout=30) as client:
         try:
             async with client.stream("POST", client_cfg['base_url'], headers=headers, json=payload) as response:
@@ -212,12 +201,11 @@ async def astream_llama_cpp_response(
                 
                 # Final validation of argument JSON
                 for call in final_tool_calls:
-                    try:
-                        json.loads(call["function"]["arguments"])
-                    except json.JSONDecodeError as e:
-                        # The accumulated arguments are not valid JSON.
+                    ok, problem = validate_tool_call(call, tools)
+                    record_tool_call("chat", ok)
+                    if not ok:
                         # This can happen if the model output is malformed.
-                        print(f"Warning: Could not parse tool call arguments for call id {call.get('id')}. Error: {e}", file=sys.stderr)
+                        print(f"Warning: Malformed tool call id {call.get('id')}: {problem}", file=sys.stderr)
 
                 yield [{
                     "delta": {"tool_calls": final_tool_calls},
@@ -229,3 +217,74 @@ async def astream_llama_cpp_response(
             print(f"Details: {e}")
             yield None
 
+
+async def astream_llama_cpp_completion(
+    prompt: str,
+    client_cfg: Dict = None,
+    tools: List = None,
+    constraints: Dict[str, Any] = None,
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    Streams a raw-prompt completion from llama-server's /completion endpoint.
+    Yields events shaped like `astream_llama_cpp_response`, with reasoning and
+    content split out of the raw text and tool calls parsed at the end. The
+    last event also carries `raw_text`, the exact generated text, so the
+    caller can extend its cached prompt byte for byte.
+
+    `constraints` are extra payload fields such as a lazy tool-call grammar
+    (see tool_grammar.tool_call_constraints).
+    """
+    payload = {
+        "prompt": prompt,
+        "stream": True,
+        # Reuse the KV cache for the longest matching prompt prefix.
+        "cache_prompt": True,
+        **(constraints or {}),
+    }
+    headers = {"Content-Type": "application/json"}
+    parser = RawOutputParser()
+    stopped = False
+
+    import httpx
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        try:
+            async with client.stream("POST", client_cfg['completion_url'], headers=headers, json=payload) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.strip().startswith("data:"):
+                        continue
+                    try:
+                        chunk = json.loads(line.split("data:", 1)[1].strip())
+                    except json.JSONDecodeError:
+                        continue
+                    for kind, text in parser.feed(chunk.get("content", "")):
+                        key = "reasoning_content" if kind == "reasoning" else "content"
+                        yield [{"delta": {key: text}}]
+                    if chunk.get("stop"):
+                        stopped = True
+                        if timings := chunk.get("timings"):
+                            print(f"--- Prompt tokens: {chunk.get('tokens_evaluated')}, cached: {chunk.get('tokens_cached')}, prompt ms: {timings.get('prompt_ms')} ---")
+                        break
+        except httpx.RequestError as e:
+            print(f"\n[Request Error: Could not connect to the server or request failed. Ensure llama.cpp is running at {client_cfg['completion_url']}]")
+            print(f"Details: {e}")
+            yield None
+            return
+
+    deltas, tool_calls = parser.finish()
+    mode = "raw+grammar" if constraints and constraints.get("grammar") else "raw"
+    if parser.saw_tool_markup and not tool_calls:
+        record_tool_call(mode, False)
+    for call in tool_calls:
+        ok, problem = validate_tool_call(call, tools)
+        record_tool_call(mode, ok)
+        if not ok:
+            print(f"Warning: Malformed tool call id {call.get('id')}: {problem}", file=sys.stderr)
+    for kind, text in deltas:
+        key = "reasoning_content" if kind == "reasoning" else "content"
+        yield [{"delta": {key: text}}]
+    if tool_calls:
+        yield [{"delta": {"tool_calls": tool_calls}, "finish_reason": "tool_calls", "raw_text": parser.raw_text}]
+    else:
+        yield [{"delta": {}, "finish_reason": "stop" if stopped else None, "raw_text": parser.raw_text}]
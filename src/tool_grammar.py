@@ -0,0 +1,196 @@
+import os
+import json
+import functools
+from typing import Dict, Any, List, Optional, Tuple
+
+# Constrain tool calls in raw-completion mode (on by default).
+TOOL_GRAMMAR_ENABLED = os.environ.get("UFD_TOOL_GRAMMAR", "1") == "1"
+
+# llama-server's grammar trigger types (common_grammar_trigger_type).
+GRAMMAR_TRIGGER_TYPE_WORD = 1
+
+TOOL_CALL_OPEN = "<tool_call>"
+TOOL_CALL_CLOSE = "</tool_call>"
+
+# Generic JSON rules, as in llama.cpp's grammars/json.gbnf.
+JSON_RULES = {
+    "ws": '| " " | "\\n" [ \\t]{0,20}',
+    "value": 'object | array | string | number | boolean | null',
+    "object": '"{" ws ( string ":" ws value ( "," ws string ":" ws value )* )? "}" ws',
+    "array": '"[" ws ( value ( "," ws value )* )? "]" ws',
+    "string": '"\\"" ( [^"\\\\\\x7F\\x00-\\x1F] | "\\\\" ( ["\\\\/bfnrt] | "u" [0-9a-fA-F]{4} ) )* "\\"" ws',
+    "number": '"-"? ( [0-9] | [1-9] [0-9]{0,15} ) ( "." [0-9]+ )? ( [eE] [-+]? [0-9]{1,15} )? ws',
+    "integer": '"-"? ( [0-9] | [1-9] [0-9]{0,15} ) ws',
+    "boolean": '( "true" | "false" ) ws',
+    "null": '"null" ws',
+    # Raw text inside an XML <parameter> tag; it may not start a closing tag.
+    "xml-value": '( [^<] | "<" [^/] )*',
+}
+
+PRIMITIVE_RULES = {"string", "number", "integer", "boolean", "null"}
+
+# Malformed-call counters per decoding mode ("chat", "raw", "raw+grammar"),
+# so the effect of constraining can be compared directly.
+_tool_call_stats: Dict[str, Dict[str, int]] = {}
+
+
+def _literal(text: str) -> str:
+    """ Quotes `text` as a GBNF string literal. """
+    escaped = text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\t", "\\t")
+    return f'"{escaped}"'
+
+
+class _GrammarBuilder:
+
+    def __init__(self):
+        self.rules: Dict[str, str] = {}
+
+    def add(self, name: str, body: str) -> str:
+        self.rules[name] = body
+        return name
+
+    def schema(self, schema: Dict[str, Any], name: str) -> str:
+        """ Returns the rule matching JSON values of `schema` (a practical JSON Schema subset). """
+        if "enum" in schema:
+            options = " | ".join(_literal(json.dumps(v, ensure_ascii=False)) for v in schema["enum"])
+            return self.add(name, f"( {options} ) ws")
+        schema_type = schema.get("type")
+        if isinstance(schema_type, str) and schema_type in PRIMITIVE_RULES:
+            return schema_type
+        if schema_type == "array" and isinstance(schema.get("items"), dict):
+            item = self.schema(schema["items"], f"{name}-item")
+            return self.add(name, f'"[" ws ( {item} ( "," ws {item} )* )? "]" ws')
+        if schema_type == "object":
+            # Without `properties` the object is free-form; with them, even
+            # an empty mapping, only the listed keys are allowed.
+            return self._object(schema, name) if isinstance(schema.get("properties"), dict) else "object"
+        return "value"
+
+    def _object(self, schema: Dict[str, Any], name: str) -> str:
+        properties = schema["properties"]
+        required_keys = schema.get("required") or []
+        required = [key for key in properties if key in required_keys]
+        optional = [key for key in properties if key not in required_keys]
+        pairs = {
+            key: f'{_literal(json.dumps(key))} ":" ws {self.schema(properties[key], f"{name}-{key}")}'
+            for key in properties
+        }
+
+        def optional_tail(keys):
+            return "".join(f' ( "," ws {pairs[key]} )?' for key in keys)
+
+        if required:
+            body = ' "," ws '.join(pairs[key] for key in required) + optional_tail(optional)
+        elif optional:
+            # Any subset of the optional keys, in order, without a leading comma.
+            alternatives = [pairs[key] + optional_tail(optional[index + 1:]) for index, key in enumerate(optional)]
+            body = f'( {" | ".join(alternatives)} )?'
+        else:
+            body = ""
+        return self.add(name, " ".join(part for part in ('"{" ws', body, '"}" ws') if part))
+
+    def xml_parameters(self, parameters: Dict[str, Any], name: str) -> str:
+        """ Parameters in the `<parameter=...>` XML layout used by qwen.j2. """
+        properties = parameters.get("properties", {})
+        required = set(parameters.get("required", []))
+        parts = []
+        for key in properties:
+            part = f'{_literal(f"<parameter={key}>")} "\\n" xml-value "\\n" {_literal("</parameter>")} "\\n"'
+            parts.append(part if key in required else f"( {part} )?")
+        return self.add(name, " ".join(parts) or '""')
+
+    def render(self) -> str:
+        rules = {**self.rules, **JSON_RULES}
+        return "\n".join(f"{name} ::= {body}" for name, body in rules.items())
+
+
+def _tool_name(tool: Dict[str, Any]) -> str:
+    return tool.get("function", tool)["name"]
+
+
+def _tool_parameters(tool: Dict[str, Any]) -> Dict[str, Any]:
+    return tool.get("function", tool).get("parameters") or {"type": "object", "properties": {}}
+
+
+@functools.lru_cache(maxsize=32)
+def _compile(tools_key: str, tool_format: str) -> str:
+    tools = json.loads(tools_key)
+    builder = _GrammarBuilder()
+    alternatives = []
+    for index, tool in enumerate(tools):
+        name = _tool_name(tool)
+        if tool_format == "xml":
+            params = builder.xml_parameters(_tool_parameters(tool), f"tool{index}-params")
+            alternatives.append(builder.add(
+                f"tool{index}",
+                f'{_literal(f"<function={name}>")} "\\n" {params} {_literal("</function>")} "\\n"',
+            ))
+        else:
+            args = builder.schema(_tool_parameters(tool), f"tool{index}-args")
+            prefix = '"name": ' + json.dumps(name) + ', "arguments": '
+            alternatives.append(builder.add(f"tool{index}", f"{_literal(prefix)} {args}"))
+    if tool_format == "xml":
+        call = f'{_literal(TOOL_CALL_OPEN)} "\\n" ( {" | ".join(alternatives)} ) {_literal(TOOL_CALL_CLOSE)}'
+    else:
+        call = f'{_literal(TOOL_CALL_OPEN)} "\\n" "{{" ( {" | ".join(alternatives)} ) "}}" "\\n" {_literal(TOOL_CALL_CLOSE)}'
+    builder.add("call", call)
+    builder.rules = {"root": 'call ( "\\n" call )*', **builder.rules}
+    return builder.render()
+
+
+def tool_call_grammar(tools: List[Dict[str, Any]], tool_format: str) -> str:
+    """
+    GBNF grammar for one or more tool calls in the template's format
+    ("hermes": `<tool_call>{json}</tool_call>`, "xml": `<function=...>`),
+    with arguments constrained by each tool's parameter schema. Compiled once
+    per tool set and format.
+    """
+    return _compile(json.dumps(tools, sort_keys=True), tool_format)
+
+
+def tool_call_constraints(tools: Optional[List[Dict[str, Any]]], tool_format: str) -> Dict[str, Any]:
+    """
+    Extra /completion payload fields that constrain tool calls. The grammar is
+    lazy: free text and reasoning are unconstrained until the model emits
+    `<tool_call>`, and from then on only schema-valid calls can be sampled.
+    """
+    if not tools or not TOOL_GRAMMAR_ENABLED:
+        return {}
+    return {
+        "grammar": tool_call_grammar(tools, tool_format),
+        "grammar_lazy": True,
+        "grammar_triggers": [{"type": GRAMMAR_TRIGGER_TYPE_WORD, "value": TOOL_CALL_OPEN}],
+        "preserved_tokens": [TOOL_CALL_OPEN, TOOL_CALL_CLOSE],
+    }
+
+
+def validate_tool_call(call: Dict[str, Any], tools: Optional[List[Dict[str, Any]]]) -> Tuple[bool, str]:
+    """ Checks that a call names a known tool and its arguments are a JSON object with the required keys. """
+    name = call.get("function", {}).get("name")
+    by_name = {_tool_name(tool): tool for tool in tools or []}
+    if name not in by_name:
+        return False, f"unknown tool {name!r}"
+    try:
+        arguments = json.loads(call["function"].get("arguments") or "{}")
+    except json.JSONDecodeError as e:
+        return False, f"arguments are not valid JSON: {e}"
+    if not isinstance(arguments, dict):
+        return False, "arguments are not a JSON object"
+    missing = [key for key in _tool_parameters(by_name[name]).get("required", []) if key not in arguments]
+    if missing:
+        return False, f"missing required arguments {missing}"
+    return True, ""
+
+
+def record_tool_call(mode: str, ok: bool):
+    stats = _tool_call_stats.setdefault(mode, {"calls": 0, "malformed": 0})
+    stats["calls"] += 1
+    if not ok:
+        stats["malformed"] += 1
+
+
+def tool_call_stats() -> Dict[str, Dict[str, Any]]:
+    return {
+        mode: {**stats, "malformed_rate": round(stats["malformed"] / stats["calls"], 4) if stats["calls"] else 0.0}
+        for mode, stats in _tool_call_stats.items()
+    }
@@ -0,0 +1,313 @@
+"""
+Tool registry. Functions decorated with `@tool` become callable by the model;
+their schema (the `tools` list sent to llama-server) is derived from the
+signature, so a tool is declared in exactly one place.
+
+Each tool gets its own timeout, retry count and concurrency limit. Async tools
+run on the event loop and share one pooled HTTP client; blocking tools run in
+their own small thread pool, so a hung tool can only tie up its own threads.
+"""
+import os
+import json
+import time
+import asyncio
+import inspect
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Callable, Tuple
+
+from .config import env_float
+
+# Tools offered to the model, by name. Other registered tools stay callable
+# but are not advertised.
+ENABLED_TOOLS = [name.strip() for name in os.environ.get("UFD_TOOLS", "run_code_interpreter").split(",") if name.strip()]
+HTTP_TIMEOUT_SECONDS = env_float("UFD_TOOL_HTTP_TIMEOUT_SECONDS", 10)
+HTTP_MAX_CONNECTIONS = int(env_float("UFD_TOOL_HTTP_MAX_CONNECTIONS", 20))
+RETRY_BACKOFF_SECONDS = 0.5
+LATENCY_WINDOW = 200
+
+# Filled in by the runtime rather than the model; never part of a schema.
+CONTEXT_PARAMETERS = ("files", "session_id")
+
+JSON_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean", list: "array", dict: "object"}
+
+
+class TransientToolError(Exception):
+    """ A failure worth retrying, e.g. a dropped connection or an HTTP 5xx. """
+
+
+@dataclass
+class ToolSpec:
+    name: str
+    fn: Callable
+    schema: Dict[str, Any]
+    timeout: float
+    retries: int
+    concurrency: int
+    format_result: Optional[Callable[[Any], Tuple[str, bool]]] = None
+    is_async: bool = False
+    context: Tuple[str, ...] = ()
+    semaphore: Optional[asyncio.Semaphore] = None
+    executor: Optional[ThreadPoolExecutor] = None
+    stats: Dict[str, Any] = field(default_factory=lambda: {
+        "calls": 0, "errors": 0, "timeouts": 0, "retries": 0, "in_flight": 0, "total_ms": 0.0, "max_ms": 0.0,
+        "recent_ms": deque(maxlen=LATENCY_WINDOW),
+    })
+
+
+TOOLS: Dict[str, ToolSpec] = {}
+
+_http: Dict[str, Any] = {"client": None}
+
+
+def _json_type(annotation: Any) -> Dict[str, Any]:
+    origin = getattr(annotation, "__origin__", None)
+    if origin is not None and annotation.__args__ and type(None) in annotation.__args__:
+        # Optional[X] -> X
+        annotation = next(arg for arg in annotation.__args__ if arg is not type(None))
+        origin = getattr(annotation, "__origin__", None)
+    return {"type": JSON_TYPES.get(origin or annotation, "string")}
+
+
+def _derive_schema(fn: Callable, name: str, description: str, params: Dict[str, str]) -> Dict[str, Any]:
+    properties, required = {}, []
+    for parameter in inspect.signature(fn).parameters.values():
+        if parameter.name in CONTEXT_PARAMETERS:
+            continue
+        prop = _json_type(parameter.annotation)
+        if parameter.name in params:
+            prop["description"] = params[parameter.name]
+        properties[parameter.name] = prop
+        if parameter.default is inspect.Parameter.empty:
+            required.append(parameter.name)
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": description,
+            "parameters": {"type": "object", "properties": properties, "required": required},
+            "strict": False,
+        },
+    }
+
+
+def tool(description: Optional[str] = None,
+         params: Optional[Dict[str, str]] = None,
+         name: Optional[str] = None,
+         timeout: float = 30,
+         retries: int = 0,
+         concurrency: int = 4,
+         format_result: Optional[Callable[[Any], Tuple[str, bool]]] = None):
+    """
+    Registers a tool. `description` defaults to the docstring and `params`
+    describes individual arguments. `retries` only covers timeouts and
+    TransientToolError, so leave it at 0 for tools with side effects.
+    `format_result` turns the return value into (content, is_error); by
+    default strings pass through and anything else is sent as JSON.
+    """
+    def register(fn: Callable) -> Callable:
+        tool_name = name or fn.__name__
+        is_async = inspect.iscoroutinefunction(fn)
+        TOOLS[tool_name] = ToolSpec(
+            name=tool_name,
+            fn=fn,
+            schema=_derive_schema(fn, tool_name, description or inspect.getdoc(fn) or "", params or {}),
+            timeout=timeout,
+            retries=retries,
+            concurrency=concurrency,
+            format_result=format_result,
+            is_async=is_async,
+            context=tuple(p for p in CONTEXT_PARAMETERS if p in inspect.signature(fn).parameters),
+            executor=None if is_async else ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"tool-{tool_name}"),
+        )
+        return fn
+    return register
+
+
+def available_tools(names: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """ Schemas of the enabled tools, in the form llama-server expects. """
+    names = ENABLED_TOOLS if names is None else names
+    missing = [n for n in names if n not in TOOLS]
+    if missing:
+        print(f"--- Unknown tools in UFD_TOOLS ignored: {missing} ---")
+    return [TOOLS[n].schema for n in names if n in TOOLS]
+
+
+def get_tool(name: str) -> Optional[ToolSpec]:
+    return TOOLS.get(name)
+
+
+def get_http_client():
+    """ The HTTP client shared by all async tools, created on first use. """
+    if _http["client"] is None:
+        import httpx
+        _http["client"] = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS // 2),
+        )
+    return _http["client"]
+
+
+async def http_json(method: str, url: str, **kwargs) -> Any:
+    """ Makes a request with the shared client, raising TransientToolError for retryable failures. """
+    import httpx
+    try:
+        response = await get_http_client().request(method, url, **kwargs)
+    except httpx.TransportError as e:
+        raise TransientToolError(f"{method} {url} failed: {e!r}") from e
+    if response.status_code == 429 or response.status_code >= 500:
+        raise TransientToolError(f"{method} {url} returned {response.status_code}")
+    response.raise_for_status()
+    return response.json()
+
+
+async def close_tools():
+    if _http["client"] is not None:
+        await _http["client"].aclose()
+        _http["client"] = None
+    for spec in TOOLS.values():
+        if spec.executor is not None:
+            spec.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _coerce_arguments(spec: ToolSpec, arguments: Any) -> Dict[str, Any]:
+    """ Parses model-written arguments, tolerating double-encoded JSON and a bare single value. """
+    if isinstance(arguments, str):
+        arguments = json.loads(arguments) if arguments.strip() else {}
+    if isinstance(arguments, str):
+        try:
+            arguments = json.loads(arguments)
+        except json.JSONDecodeError:
+            # A bare value, e.g. the code itself for run_code_interpreter.
+            pass
+    if not isinstance(arguments, dict):
+        required = spec.schema["function"]["parameters"]["required"]
+        if len(required) != 1:
+            raise ValueError(f"Arguments for {spec.name} must be a JSON object.")
+        arguments = {required[0]: arguments}
+    return arguments
+
+
+def _release_soon(loop: asyncio.AbstractEventLoop, release: Callable[[], None]):
+    try:
+        loop.call_soon_threadsafe(release)
+    except RuntimeError:
+        # The loop has closed; nothing is left waiting for the slot.
+        pass
+
+
+async def _run_once(spec: ToolSpec, kwargs: Dict[str, Any]) -> Any:
+    """
+    One attempt, holding a concurrency slot for as long as the work really
+    runs. A timeout can't stop a blocking tool's thread, so its slot (and
+    `in_flight`) is only released when the thread returns.
+    """
+    await spec.semaphore.acquire()
+    spec.stats["in_flight"] += 1
+
+    def release():
+        spec.stats["in_flight"] -= 1
+        spec.semaphore.release()
+
+    if spec.is_async:
+        try:
+            return await asyncio.wait_for(spec.fn(**kwargs), spec.timeout)
+        finally:
+            release()
+    loop = asyncio.get_running_loop()
+    try:
+        thread_future = spec.executor.submit(functools.partial(spec.fn, **kwargs))
+    except BaseException:
+        release()
+        raise
+    thread_future.add_done_callback(lambda _: _release_soon(loop, release))
+    # wait_for can't stop the thread, but it stops the agent waiting on it.
+    return await asyncio.wait_for(asyncio.wrap_future(thread_future), spec.timeout)
+
+
+def _record_latency(spec: ToolSpec, started: float):
+    elapsed_ms = (time.monotonic() - started) * 1000
+    stats = spec.stats
+    stats["total_ms"] += elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+    stats["recent_ms"].append(elapsed_ms)
+
+
+async def _run_with_retries(spec: ToolSpec, kwargs: Dict[str, Any]) -> Any:
+    """ Retries timeouts and transient failures with exponential backoff; re-raises the last one. """
+    for attempt in range(spec.retries + 1):
+        if attempt:
+            spec.stats["retries"] += 1
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+        try:
+            return await _run_once(spec, kwargs)
+        except asyncio.TimeoutError:
+            spec.stats["timeouts"] += 1
+            if attempt == spec.retries:
+                raise TransientToolError(f"{spec.name} timed out after {spec.timeout:g}s")
+        except TransientToolError:
+            if attempt == spec.retries:
+                raise
+
+
+async def invoke_tool(name: str, arguments: Any, context: Dict[str, Any]) -> Tuple[str, bool]:
+    """
+    Runs a tool call under the tool's concurrency limit, timeout and retry
+    policy. Returns (content, is_error); failures are reported, not raised,
+    so the model can see them and try again.
+    """
+    spec = TOOLS.get(name)
+    if spec is None:
+        return f"Unknown tool {name!r}. Available tools: {', '.join(ENABLED_TOOLS)}", True
+    try:
+        kwargs = _coerce_arguments(spec, arguments)
+    except (json.JSONDecodeError, ValueError) as e:
+        return f"Invalid arguments for {name}: {e}", True
+    kwargs.update({key: context.get(key) for key in spec.context})
+
+    stats = spec.stats
+    stats["calls"] += 1
+    if spec.semaphore is None:
+        spec.semaphore = asyncio.Semaphore(spec.concurrency)
+    started = time.monotonic()
+    try:
+        result = await _run_with_retries(spec, kwargs)
+        if spec.format_result:
+            return spec.format_result(result)
+        if isinstance(result, str):
+            return result, False
+        return json.dumps(result, ensure_ascii=False, default=str), False
+    except Exception as e:
+        stats["errors"] += 1
+        return f"Error executing tool: {e}", True
+    finally:
+        _record_latency(spec, started)
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def tool_metrics() -> Dict[str, Dict[str, Any]]:
+    """ Per-tool call counts and latency, with percentiles over recent calls. """
+    metrics = {}
+    for name, spec in TOOLS.items():
+        stats = spec.stats
+        recent = list(stats["recent_ms"])
+        metrics[name] = {
+            "calls": stats["calls"],
+            "errors": stats["errors"],
+            "timeouts": stats["timeouts"],
+            "retries": stats["retries"],
+            "in_flight": stats["in_flight"],
+            "mean_ms": round(stats["total_ms"] / stats["calls"], 1) if stats["calls"] else 0.0,
+            "max_ms": round(stats["max_ms"], 1),
+            "p50_ms": round(_percentile(recent, 0.5), 1) if recent else None,
+            "p95_ms": round(_percentile(recent, 0.95), 1) if recent else None,
+            "timeout_s": spec.timeout,
+            "concurrency": spec.concurrency,
+        }
+    return metrics
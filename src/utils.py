@@ -1,13 +1,10 @@
 from textwrap import dedent
 import os
-import requests
 from .sandbox_manager import get_sandbox
-from typing import Any, List, Dict
-from e2b_code_interpreter import Sandbox
+from .tools import tool, http_json
+from typing import Any, List, Dict, Tuple
 from typing import Optional
 
-e2b_key = os.environ['E2B_API_KEY']
-
 react_instructions = dedent("""
         You are an expert with strong analytical skills! 🧠""")
         # You have access to tools. To call a tool, you make a function call with the function name and the arguments in json format.
@@ -18,8 +15,13 @@ react_instructions = dedent("""
 
 def create_message_with_files(prompt: str,
     file_paths: List[str],
+    file_summaries: Optional[List[str]] = None,
 ) -> List[Dict[str, Any]]:
-    """ Creates a list containing a single user prompt with files. """
+    """ Creates a list containing a single user prompt with files.
+
+    `file_summaries` are precomputed data profiles (see file_profiler) so the
+    model doesn't spend tool calls on `df.head()`/`df.info()` to learn the data.
+    """
     
     content_parts = [{"type": "text", "text": prompt}]
     
@@ -31,6 +33,11 @@ def create_message_with_files(prompt: str,
             "type": "text", 
             "text": f"\nThe following file(s) have been uploaded and are available in the current working directory: {file_list_str}"
         })
+    if file_summaries:
+        content_parts.append({
+            "type": "text",
+            "text": "\nData profile of the new file(s):\n" + "\n\n".join(file_summaries)
+        })
 
     # If there is only one part (just the text prompt), use a simple string for content.
     # Otherwise, use the list of parts to accommodate file information.
@@ -45,21 +52,49 @@ def create_message_with_files(prompt: str,
     
     return [user_message]
 
-def get_current_temperature(latitude, longitude):
-    url = "https://api.open-meteo.com/v1/forecast"
-    params = {
-    	"latitude": [float(f"{latitude}")],
-    	"longitude": [float(f"{longitude}")],
-    	"current": ["temperature_2m"],
-    	"timezone": ["auto"],
-    }
-    response = requests.post(url, json=params).json()
+@tool(
+    description="Get the current temperature in degrees Celsius at a location.",
+    params={"latitude": "Latitude of the location.", "longitude": "Longitude of the location."},
+    timeout=10,
+    retries=2,
+)
+async def get_current_temperature(latitude: float, longitude: float) -> float:
+    response = await http_json("GET", "https://api.open-meteo.com/v1/forecast", params={
+        "latitude": float(latitude),
+        "longitude": float(longitude),
+        "current": "temperature_2m",
+        "timezone": "auto",
+    })
     return response['current']['temperature_2m']
-    
-def get_current_location():
-    ll = requests.post("http://ip-api.com/json?fields=lat,lon").json()
-    return ll['lat'], ll['lon']
 
+@tool(description="Get the approximate latitude and longitude of the user.", timeout=10, retries=2)
+async def get_current_location() -> Dict[str, float]:
+    ll = await http_json("GET", "http://ip-api.com/json", params={"fields": "lat,lon"})
+    return {"latitude": ll['lat'], "longitude": ll['lon']}
+
+def format_execution(execution: Any) -> Tuple[str, bool]:
+    """ Formats a sandbox execution as model-friendly text, and whether it raised. """
+    parsed_outputs = parse_sbx_exec(execution)
+    content_str = ""
+    for output in parsed_outputs:
+        if output['output_type'] == 'stream':
+            content_str += f"Output from {output['name']}:\n{output['text']}\n"
+        elif output['output_type'] == 'execute_result':
+            if 'text/plain' in output['data']:
+                content_str += f"Result:\n{output['data']['text/plain']}\n"
+        elif output['output_type'] == 'error':
+            content_str += f"An error occurred: {output['ename']}\n{output['evalue']}\n"
+
+    if not content_str.strip():
+        content_str = "Tool executed successfully with no output."
+    return content_str, any(out.get('output_type') == 'error' for out in parsed_outputs)
+
+@tool(
+    description="A powerful Python code execution environment for complex math, data analysis, and general programming tasks. Input only raw Python code, no explanation needed.",
+    params={"code": "The python code to execute."},
+    timeout=300,
+    format_result=format_execution,
+)
 def run_code_interpreter(code: str,
         files: Optional[list[dict[str, Any]]] = None,
         session_id: str = None,
@@ -158,3 +193,13 @@ def read_directory_files(directory_path):
                     'data': file.read()
                 })
     return files
+
+def load_session_files(manifest: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """ Reloads the bytes for a stored file manifest so any worker can rebuild a session. """
+    files = []
+    for entry in manifest:
+        local_path = entry.get("local_path")
+        if local_path and os.path.isfile(local_path):
+            with open(local_path, "rb") as file:
+                files.append({**entry, "data": file.read()})
+    return files
@@ -0,0 +1,131 @@
+import json
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+import src.app as app_module
+from src import batch
+from src.batch import _succeeded_ids, parse_items, resolve_item_files
+
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "BATCH_FILES_DIR", str(tmp_path))
+    monkeypatch.setattr(batch, "BATCH_DIR", str(tmp_path / "batch"))
+    monkeypatch.setattr(batch, "SESSION_DB_PATH", str(tmp_path / "sessions.db"))
+    return tmp_path
+
+
+def write(path, data=b"x"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_parse_items_numbers_lines_and_skips_blanks():
+    items = parse_items('{"prompt": "a"}\n\n{"prompt": "b", "id": 7, "files": ["tmp/x.csv"]}\n')
+    assert [(item["id"], item["prompt"]) for item in items] == [("1", "a"), ("7", "b")]
+    assert items[1]["files"] == ["tmp/x.csv"]
+
+
+@pytest.mark.parametrize("text, message", [
+    ("not json", "Line 1 is not valid JSON"),
+    ('{"id": 1}', "Line 1 must be an object"),
+    ('{"prompt": "a", "id": "x"}\n{"prompt": "b", "id": "x"}', "Line 2 repeats item id 'x'"),
+    ('{"prompt": "a", "files": "x.csv"}', "'files' must be a list"),
+])
+def test_parse_items_rejects_bad_lines(text, message):
+    with pytest.raises(ValueError, match=message):
+        parse_items(text)
+
+
+def test_succeeded_ids_uses_latest_result(tmp_path):
+    path = tmp_path / "results.jsonl"
+    path.write_text(
+        '{"id": "1", "status": "error"}\n'
+        '{"id": "1", "status": "ok"}\n'
+        '{"id": "2", "status": "ok"}\n'
+        '{"id": "2", "status": "error"}\n'
+        '{"id": "3", "sta'
+    )
+    assert _succeeded_ids(str(path)) == {"1"}
+    assert _succeeded_ids(str(tmp_path / "missing.jsonl")) == set()
+
+
+def test_resolve_item_files_accepts_uploads(uploads):
+    top = write(uploads / "data.csv", b"a,b\n")
+    moved = write(uploads / "1712345" / "other.csv")
+
+    files = resolve_item_files([top, moved])
+    assert [f["path"] for f in files] == ["data.csv", "other.csv"]
+    assert files[0]["data"] == b"a,b\n"
+
+
+def test_resolve_item_files_rejects_store_and_batch_outputs(uploads):
+    rejected = [
+        write(uploads / "sessions.db"),
+        write(uploads / "sessions.db-wal"),
+        write(uploads / "batch" / "job" / "results.jsonl"),
+        write(uploads / "1712345" / "nested" / "x.csv"),
+        write(uploads.parent / "outside.csv"),
+        str(uploads / "missing.csv"),
+    ]
+    for path in rejected:
+        with pytest.raises(ValueError, match="not found among the uploaded files"):
+            resolve_item_files([path])
+
+
+@pytest.fixture
+def client(uploads):
+    with TestClient(app_module.app) as client:
+        yield client
+
+
+def test_post_batch_rejects_bad_job_id(client):
+    response = client.post("/batch?job_id=../x", content=json.dumps({"prompt": "a"}))
+    assert response.status_code == 400
+    assert "Job IDs" in response.json()["detail"]
+
+
+def test_resume_unknown_job_is_404(client):
+    assert client.post("/batch?job_id=nope").status_code == 404
+    assert client.get("/batch/nope").status_code == 404
+
+
+def test_post_batch_rejects_bad_body(client):
+    response = client.post("/batch", content="not json")
+    assert response.status_code == 400
+    assert not os.path.exists(batch.BATCH_DIR)
+
+
+async def unreachable_stream(messages=None, tools=None, client_cfg=None, **kwargs):
+    # What astream_llama_cpp_response yields on httpx.RequestError.
+    yield None
+
+
+async def unfinished_stream(messages=None, tools=None, client_cfg=None, **kwargs):
+    yield [{"delta": {"content": "partial"}}]
+
+
+async def answering_stream(messages=None, tools=None, client_cfg=None, **kwargs):
+    yield [{"delta": {"content": "An answer."}}]
+    yield [{"delta": {}, "finish_reason": "stop"}]
+
+
+@pytest.mark.parametrize("stream, status", [
+    (unreachable_stream, "error"),
+    (unfinished_stream, "error"),
+    (answering_stream, "ok"),
+])
+def test_item_status_reflects_how_the_run_ended(client, monkeypatch, stream, status):
+    monkeypatch.setattr(app_module, "astream_llama_cpp_response", stream)
+    monkeypatch.setitem(app_module.client_cfg, "mode", "chat")
+    response = client.post("/batch?job_id=job1&max_iterations=2", content=json.dumps({"prompt": "a"}))
+
+    result = json.loads(response.text.splitlines()[0])
+    assert result["status"] == status
+    if status == "error":
+        assert result["errors"]
+        # A resumed job runs the item again.
+        assert _succeeded_ids(batch.results_path("job1")) == set()
@@ -0,0 +1,143 @@
+import asyncio
+import json
+
+import pytest
+
+from src import chat_template
+from src.chat_template import (
+    PromptCache,
+    RawOutputParser,
+    get_chat_template,
+    parse_tool_calls,
+)
+from src.utils import create_message_with_files
+
+TEMPLATES = ["chat.j2", "qwen.j2", "unsloth.j2"]
+
+
+@pytest.mark.parametrize("name", TEMPLATES)
+def test_renders_message_with_attached_files(name):
+    messages = [{"role": "system", "content": "Be brief."}]
+    messages += create_message_with_files("Summarise it.", ["tmp/abc/data.csv"], ["rows: 3"])
+    cache = PromptCache(get_chat_template(name))
+    cache.sync(messages)
+
+    text = cache.text
+    assert "Summarise it.\nThe following file(s) have been uploaded" in text
+    assert "'data.csv'" in text
+    assert "Data profile of the new file(s):\nrows: 3" in text
+    # The original message is left as content parts for the chat endpoint.
+    assert isinstance(messages[1]["content"], list)
+
+
+@pytest.mark.parametrize("name", TEMPLATES)
+def test_incremental_prompt_matches_full_render(name):
+    template = get_chat_template(name)
+    messages = [{"role": "system", "content": "Be brief."}, {"role": "user", "content": "Hi"}]
+    cache = PromptCache(template)
+    cache.sync(messages)
+    messages = messages + [
+        {"role": "assistant", "content": "Hello."},
+        *create_message_with_files("Now this.", ["tmp/abc/data.csv"]),
+    ]
+    cache.sync(messages)
+
+    assert len(cache.segments) == 2
+    assert cache.text == template.render(chat_template._normalise_messages(messages))
+
+
+def test_count_tokens_counts_only_new_segments(monkeypatch):
+    calls = []
+
+    async def fake_tokenize(text, client_cfg):
+        calls.append(text)
+        return list(text)
+
+    monkeypatch.setattr(chat_template, "tokenize", fake_tokenize)
+    cache = PromptCache(get_chat_template("chat.j2"))
+    cache.sync([{"role": "user", "content": "Hi"}])
+    assert asyncio.run(cache.count_tokens({})) == len(cache.prompt())
+    cache.append_generation("Hello.")
+    assert asyncio.run(cache.count_tokens({})) == len(cache.prompt())
+    # The generation prompt once, then one call per segment.
+    assert len(calls) == 3
+
+
+def test_count_tokens_discards_result_after_rebuild(monkeypatch):
+    cache = PromptCache(get_chat_template("chat.j2"))
+    cache.sync([{"role": "user", "content": "Hi"}])
+
+    async def rebuilding_tokenize(text, client_cfg):
+        cache.sync([{"role": "user", "content": "Something else"}])
+        return list(text)
+
+    monkeypatch.setattr(chat_template, "tokenize", rebuilding_tokenize)
+    assert asyncio.run(cache.count_tokens({})) is None
+    assert cache.token_count == 0
+
+
+def test_parse_tool_calls_formats():
+    hermes = '<tool_call>\n{"name": "run_code_interpreter", "arguments": {"code": "1+1"}}\n</tool_call>'
+    xml = (
+        "<tool_call>\n<function=run_code_interpreter>\n<parameter=code>\nprint(1)\n</parameter>\n"
+        "</function>\n</tool_call>"
+    )
+    markers = "✿FUNCTION✿: run_code_interpreter\n✿ARGS✿: {\"code\": \"2\"}"
+
+    for text, code in ((hermes, "1+1"), (xml, "print(1)"), (markers, "2")):
+        calls = parse_tool_calls(text)
+        assert len(calls) == 1
+        assert calls[0]["function"]["name"] == "run_code_interpreter"
+        assert json.loads(calls[0]["function"]["arguments"]) == {"code": code}
+
+
+def test_parse_tool_calls_keeps_malformed_arguments():
+    calls = parse_tool_calls('<tool_call>{"name": "run_code_interpreter", "arguments": {"code": </tool_call>')
+    assert calls[0]["function"]["name"] == "run_code_interpreter"
+    assert calls[0]["function"]["arguments"].startswith('{"name"')
+
+
+def test_raw_output_parser_splits_reasoning_content_and_tools():
+    parser = RawOutputParser()
+    deltas = []
+    for chunk in ["<th", "ink>plan", "</think>Answer", " here<tool", '_call>{"name": "f", ', '"arguments": {}}</tool_call>']:
+        deltas += parser.feed(chunk)
+    final, tool_calls = parser.finish()
+    deltas += final
+
+    assert "".join(t for kind, t in deltas if kind == "reasoning") == "plan"
+    assert "".join(t for kind, t in deltas if kind == "content") == "Answer here"
+    assert [call["function"]["name"] for call in tool_calls] == ["f"]
+
+
+def test_raw_output_parser_shows_markup_that_is_not_a_call():
+    parser = RawOutputParser()
+    deltas = parser.feed("See <tool_call> for details")
+    final, tool_calls = parser.finish()
+
+    assert tool_calls == []
+    assert "".join(t for _, t in deltas + final) == "See <tool_call> for details"
+
+
+class PrefixUnstableTemplate:
+    """ A template whose render_segment always asks for a full re-render. """
+    name = "unstable"
+    generation_prompt = "<gen>"
+
+    def render(self, messages, tools=None):
+        return "|".join(m["content"] for m in messages)
+
+    def render_segment(self, messages):
+        return None
+
+
+def test_sync_rebuilds_when_segment_cannot_be_rendered():
+    cache = PromptCache(PrefixUnstableTemplate())
+    cache.sync([{"role": "user", "content": "a"}])
+    cache.sync([{"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}])
+    assert cache.segments == ["a|b"]
+
+
+def test_token_count_source(monkeypatch):
+    monkeypatch.setattr(chat_template, "_local_tokenizer", lambda: None)
+    assert chat_template.token_count_source() == "llama-server /tokenize"
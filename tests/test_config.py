@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+from src.config import env_float, validate_config
+
+
+def test_env_float_falls_back_on_malformed_values(monkeypatch):
+    monkeypatch.setenv("UFD_SESSION_GRACE_SECONDS", "five minutes")
+    assert env_float("UFD_SESSION_GRACE_SECONDS", 300) == 300
+    monkeypatch.setenv("UFD_SESSION_GRACE_SECONDS", "12.5")
+    assert env_float("UFD_SESSION_GRACE_SECONDS", 300) == 12.5
+
+
+def test_validate_config_reports_problems(monkeypatch):
+    monkeypatch.delenv("E2B_API_KEY", raising=False)
+    monkeypatch.setenv("UFD_SESSION_STORE", "redis")
+    monkeypatch.setenv("UFD_SESSION_GRACE_SECONDS", "abc")
+    problems = "\n".join(validate_config())
+    assert "E2B_API_KEY" in problems
+    assert "UFD_SESSION_STORE" in problems
+    assert "UFD_SESSION_GRACE_SECONDS" in problems
+
+
+def test_malformed_setting_does_not_break_import(monkeypatch):
+    monkeypatch.setenv("UFD_SESSION_GRACE_SECONDS", "abc")
+    monkeypatch.delenv("E2B_API_KEY", raising=False)
+    proc = subprocess.run([sys.executable, "-c", "import src.app"], capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert proc.returncode == 0, proc.stderr
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from src import file_profiler
+from src.file_profiler import _profile_with_stdlib, format_profile, get_profile, schedule_profile
+
+CSV = b"name,age,score\nada,36,9.5\nbob,,7\ncy,41,8.25\n"
+
+
+def test_stdlib_csv_profile():
+    profile = _profile_with_stdlib("people.csv", CSV, "csv")
+    assert profile["rows"] == 3
+    columns = {c["name"]: c for c in profile["columns"]}
+    assert columns["name"]["dtype"] == "str"
+    assert columns["age"] == {"name": "age", "dtype": "int", "nulls": 1}
+    assert columns["score"]["dtype"] == "float"
+    assert profile["stats"]["age"] == {"min": 36.0, "max": 41.0, "mean": 38.5}
+    assert profile["sample"][0] == {"name": "ada", "age": "36", "score": "9.5"}
+
+
+def test_stdlib_jsonl_profile():
+    data = "\n".join(json.dumps({"x": i, "y": f"v{i}"}) for i in range(5)).encode()
+    profile = _profile_with_stdlib("rows.jsonl", data, "json")
+    assert profile["rows"] == 5
+    assert profile["stats"]["x"]["max"] == 4
+
+
+def test_stdlib_skips_non_tabular_json():
+    assert _profile_with_stdlib("a.json", b'{"not": "a list"}', "json") is None
+
+
+def test_format_profile_summary():
+    text = format_profile("people.csv", _profile_with_stdlib("people.csv", CSV, "csv"))
+    assert text.startswith("'people.csv' (csv, 3 rows x 3 columns)")
+    assert "age (int, 1 nulls)" in text
+    assert "Sample rows:" in text
+
+
+@pytest.fixture
+def fresh_pool():
+    file_profiler.shutdown_profiler()
+    file_profiler._profiles.clear()
+    file_profiler._upload_digests.clear()
+    yield
+    file_profiler.shutdown_profiler()
+    file_profiler._profiles.clear()
+    file_profiler._upload_digests.clear()
+
+
+def test_unsupported_files_are_not_scheduled(fresh_pool):
+    async def main():
+        return await schedule_profile("notes.txt", b"hello")
+    assert asyncio.run(main()) is None
+
+
+def test_profiling_recovers_from_a_dead_worker(fresh_pool):
+    async def main():
+        first = await get_profile("people.csv", CSV, timeout=30)
+        assert first["rows"] == 3
+        for process in list(file_profiler._get_executor()._processes.values()):
+            process.kill()
+        time.sleep(0.5)
+        file_profiler._profiles.clear()
+        # The first call may see the pool break underneath it; the next must succeed.
+        result = await get_profile("people.csv", CSV, timeout=30)
+        if result is None:
+            result = await get_profile("people.csv", CSV, timeout=30)
+        return result
+
+    assert asyncio.run(main())["rows"] == 3
+
+
+def test_schedule_profile_never_raises(fresh_pool, monkeypatch):
+    def broken():
+        raise OSError("no processes")
+    monkeypatch.setattr(file_profiler, "_get_executor", broken)
+
+    async def main():
+        return await schedule_profile("people.csv", CSV)
+    assert asyncio.run(main()) is None
+
+
+def test_upload_is_hashed_once(fresh_pool, monkeypatch):
+    hashed = []
+    real_sha256 = file_profiler.hashlib.sha256
+
+    def counting_sha256(data):
+        hashed.append(threading.current_thread() is threading.main_thread())
+        return real_sha256(data)
+    monkeypatch.setattr(file_profiler.hashlib, "sha256", counting_sha256)
+
+    async def main():
+        await schedule_profile("people.csv", CSV, upload_path="tmp/people.csv")
+        return await get_profile("people.csv", CSV, timeout=30, upload_path="tmp/people.csv")
+
+    assert asyncio.run(main())["rows"] == 3
+    # Hashed once, and not on the event loop's thread.
+    assert hashed == [False]
+    assert not file_profiler._upload_digests
+
+
+def test_finished_profiles_are_evicted_lru(fresh_pool, monkeypatch):
+    monkeypatch.setattr(file_profiler, "PROFILE_CACHE_SIZE", 2)
+    files = [CSV + f"dan,{age},1\n".encode() for age in (1, 2, 3)]
+
+    async def main():
+        digests = [await schedule_profile("people.csv", data) for data in files[:2]]
+        for data in files[:2]:
+            await get_profile("people.csv", data, timeout=30)
+        # Touch the first so the second is the least recently used.
+        await get_profile("people.csv", files[0], timeout=30)
+        digests.append(await schedule_profile("people.csv", files[2]))
+        await get_profile("people.csv", files[2], timeout=30)
+        await schedule_profile("people.csv", files[2])
+        return digests
+
+    first, second, third = asyncio.run(main())
+    assert list(file_profiler._profiles) == [first, third]
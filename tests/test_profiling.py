@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from src import profiling
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(profiling, "ADMIN_TOKEN", "secret")
+    app = FastAPI()
+    app.include_router(profiling.router)
+    return TestClient(app)
+
+
+def test_admin_routes_require_the_token(client, monkeypatch):
+    assert client.get("/admin/lag").status_code == 403
+    assert client.get("/admin/lag", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    assert client.get("/admin/lag", headers={"X-Admin-Token": "secret"}).status_code == 200
+
+    monkeypatch.setattr(profiling, "ADMIN_TOKEN", "")
+    assert client.get("/admin/lag", headers={"X-Admin-Token": ""}).status_code == 403
+
+
+def test_sample_stacks_collapses_other_threads():
+    stop = threading.Event()
+
+    def parked():
+        stop.wait(5)
+
+    thread = threading.Thread(target=parked, name="parked-thread")
+    thread.start()
+    try:
+        collapsed = profiling.sample_stacks(0.05, 200)
+    finally:
+        stop.set()
+        thread.join()
+
+    lines = [line for line in collapsed.splitlines() if line.startswith("parked-thread;")]
+    assert lines
+    stack, count = lines[0].rsplit(" ", 1)
+    assert "test_profiling.py:parked:" in stack
+    assert int(count) > 0
+
+
+def test_session_lag_is_a_no_op_when_disabled(monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", False)
+    with profiling.session_lag("s1"):
+        assert "s1" not in profiling._state["active_sessions"]
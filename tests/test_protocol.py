@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+from src.protocol import CompactEmitter, HtmxEmitter, NullEmitter, get_emitter
+
+
+class FakeWebSocket:
+    def __init__(self, query=None):
+        self.query_params = query or {}
+        self.sent = []
+
+    async def send_text(self, text):
+        self.sent.append(text)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_get_emitter_selects_by_query():
+    assert type(get_emitter(FakeWebSocket({"proto": "compact"}))) is CompactEmitter
+    assert type(get_emitter(FakeWebSocket({"proto": "bogus"}))) is HtmxEmitter
+    assert type(get_emitter(FakeWebSocket())) is HtmxEmitter
+
+
+def test_compact_ops():
+    ws = FakeWebSocket()
+    emitter = CompactEmitter(ws)
+
+    async def turn():
+        await emitter.session_token("abc")
+        await emitter.clear_chat()
+        await emitter.content_bubble("content-1")
+        await emitter.append_token("content-1", "Hel")
+        await emitter.replace_block("content-1", "<p>Hello</p>", "tail")
+        await emitter.tool_status("Executing run_code_interpreter...")
+        await emitter.error(None, "boom")
+        await emitter.finish_reasoning("reasoning-1")
+
+    run(turn())
+    assert [json.loads(frame) for frame in ws.sent] == [
+        ["k", "abc"],
+        ["c"],
+        ["n", "content", "content-1", ""],
+        ["t", "content-1", "Hel"],
+        ["r", "content-1", "<p>Hello</p>", "tail"],
+        ["s", "Executing run_code_interpreter..."],
+        ["e", None, "boom"],
+        ["f", "reasoning-1"],
+    ]
+
+
+def test_htmx_skips_raw_tokens_and_swaps_blocks():
+    ws = FakeWebSocket()
+    emitter = HtmxEmitter(ws)
+    run(emitter.append_token("content-1", "Hel"))
+    run(emitter.replace_block("content-1", "<p>Hello</p>"))
+    assert ws.sent == ['<div hx-swap-oob="innerHTML:#content-1"><p>Hello</p></div>']
+    run(emitter.error("content-1", "bad"))
+    assert 'beforeend:#content-1' in ws.sent[-1]
+
+
+
+
+def test_null_emitter_records_without_a_socket():
+    emitter = NullEmitter()
+
+    async def turn():
+        await emitter.content_bubble("content-1")
+        await emitter.tool_status("Executing x...")
+        await emitter.append_token("content-1", "a")
+        await emitter.error("content-1", "bad")
+
+    run(turn())
+    assert emitter.tool_statuses == ["Executing x..."]
+    assert emitter.errors == ["bad"]
+    assert emitter.first_token_ms is not None
@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from src.session_store import InMemorySessionStore, SQLiteSessionStore, SessionStore, new_session_state
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return InMemorySessionStore()
+    return SQLiteSessionStore(str(tmp_path / "sessions.db"))
+
+
+def test_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        SessionStore()
+
+
+def test_put_get_delete(store):
+    state = new_session_state()
+    state["files"] = [{"path": "a.csv", "local_path": "tmp/1/a.csv"}]
+    store.put("s1", state)
+    assert store.get("s1")["files"] == state["files"]
+    store.append_turn("s1", {"response_id": 1})
+    store.delete("s1")
+    assert store.get("s1") is None
+    assert store.get_turns("s1") == []
+
+
+def test_stored_state_is_a_copy(store):
+    state = new_session_state()
+    store.put("s1", state)
+    store.get("s1")["files"].append("x")
+    assert store.get("s1")["files"] == []
+
+
+def test_update_creates_and_merges(store):
+    assert store.update("s1", sandbox_id="sbx")["sandbox_id"] == "sbx"
+    state = store.update("s1", detached_at=5.0)
+    assert state["sandbox_id"] == "sbx"
+    assert state["detached_at"] == 5.0
+
+
+def test_update_if_only_applies_when_expected_matches(store):
+    store.update("s1", detached_at=1.0, sandbox_id="sbx")
+    assert store.update_if("s1", {"detached_at": 2.0}, sandbox_id=None) is None
+    assert store.get("s1")["sandbox_id"] == "sbx"
+    previous = store.update_if("s1", {"detached_at": 1.0}, sandbox_id=None)
+    assert previous["sandbox_id"] == "sbx"
+    assert store.get("s1")["sandbox_id"] is None
+
+
+def test_update_if_does_not_create_missing_sessions(store):
+    assert store.update_if("missing", {"sandbox_id": "sbx"}, sandbox_id=None) is None
+    assert store.get("missing") is None
+
+
+def test_turns_keep_order(store):
+    for n in range(3):
+        store.append_turn("s1", {"response_id": n})
+    store.append_turn("s2", {"response_id": 99})
+    assert [t["response_id"] for t in store.get_turns("s1")] == [0, 1, 2]
+
+
+def test_purge_expired_only_removes_old_detached_sessions(store):
+    store.update("attached", detached_at=None)
+    store.update("detached", detached_at=1.0)
+    store.append_turn("detached", {"response_id": 1})
+    assert store.purge_expired(3600) == 0
+    assert store.purge_expired(-1) == 1
+    assert store.get("detached") is None
+    assert store.get_turns("detached") == []
+    assert store.get("attached") is not None
+
+
+def test_concurrent_updates_are_not_lost(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    SQLiteSessionStore(path).update("s1")
+
+    def bump(field):
+        # A separate store (and connection) per thread, like separate workers.
+        worker_store = SQLiteSessionStore(path)
+        for n in range(50):
+            worker_store.update("s1", **{field: n})
+
+    threads = [threading.Thread(target=bump, args=(f"field{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    state = SQLiteSessionStore(path).get("s1")
+    assert all(state[f"field{i}"] == 49 for i in range(4))
@@ -0,0 +1,51 @@
+import gzip
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from src.static_assets import asset_response, asset_url, load_asset, IMMUTABLE_CACHE, REVALIDATE_CACHE
+
+
+@pytest.fixture(scope="module")
+def client():
+    app = FastAPI()
+
+    @app.get("/static/{path:path}")
+    async def static(request: Request, path: str):
+        return asset_response(request, path)
+
+    return TestClient(app)
+
+
+def test_gzip_body_matches_identity(client):
+    plain = client.get("/static/index.html", headers={"Accept-Encoding": "identity"})
+    compressed = client.get("/static/index.html", headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["content-encoding"] == "gzip"
+    # httpx decodes gzip transparently; the bytes must be the same document.
+    assert compressed.content == plain.content
+    assert len(load_asset("index.html")["encodings"]["gzip"]) < len(plain.content)
+    assert gzip.decompress(load_asset("index.html")["encodings"]["gzip"]) == plain.content
+
+
+def test_etag_revalidation(client):
+    first = client.get("/static/index.html")
+    assert first.headers["cache-control"] == REVALIDATE_CACHE
+    second = client.get("/static/index.html", headers={"If-None-Match": first.headers["etag"]})
+    assert second.status_code == 304
+
+
+def test_only_current_version_is_immutable(client):
+    url = asset_url("index.html")
+    assert client.get(url).headers["cache-control"] == IMMUTABLE_CACHE
+    assert client.get("/static/index.html?v=stale").headers["cache-control"] == REVALIDATE_CACHE
+
+
+def test_html_references_are_versioned():
+    html = load_asset("index.html")["encodings"]["identity"].decode()
+    assert f'href="{asset_url("favicon.ico")}"' in html
+
+
+@pytest.mark.parametrize("path", ["../app.py", "..%2Fapp.py", "missing.css"])
+def test_paths_outside_static_are_404(client, path):
+    assert client.get(f"/static/{path}").status_code == 404
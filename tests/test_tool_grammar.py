@@ -0,0 +1,156 @@
+import json
+import re
+
+import pytest
+
+from src import tool_grammar
+from src.tool_grammar import (
+    GRAMMAR_TRIGGER_TYPE_WORD,
+    record_tool_call,
+    tool_call_constraints,
+    tool_call_grammar,
+    tool_call_stats,
+    validate_tool_call,
+)
+
+TOOLS = [
+    {"type": "function", "function": {
+        "name": "run_code_interpreter",
+        "parameters": {
+            "type": "object",
+            "properties": {"code": {"type": "string"}, "timeout": {"type": "integer"}},
+            "required": ["code"],
+        },
+    }},
+    {"type": "function", "function": {
+        "name": "set_mode",
+        "parameters": {
+            "type": "object",
+            "properties": {"mode": {"enum": ["fast", "slow"]}},
+            "required": ["mode"],
+        },
+    }},
+]
+
+
+def rules(grammar):
+    return dict(line.split(" ::= ", 1) for line in grammar.splitlines())
+
+
+def referenced_rules(body):
+    # Drop string literals, character classes and repetition counts, leaving rule names.
+    body = re.sub(r'"(?:\\.|[^"\\])*"', " ", body)
+    body = re.sub(r"\[(?:\\.|[^\]\\])*\]", " ", body)
+    body = re.sub(r"\{[0-9,]*\}", " ", body)
+    return set(re.findall(r"[a-z][a-z0-9-]*", body))
+
+
+def to_regex(grammar, rule="root"):
+    """ Inlines a non-recursive GBNF grammar into one Python regex. """
+    defined = rules(grammar)
+    token = re.compile(r'"((?:\\.|[^"\\])*)"|(\[(?:\\.|[^\]\\])*\])|(\{[0-9,]*\})|([a-z][a-z0-9-]*)|([()|?*+])|\s+')
+
+    def convert(name):
+        out = []
+        for literal, char_class, count, ref, op in token.findall(defined[name]):
+            if literal or (not any((char_class, count, ref, op))):
+                out.append(re.escape(json.loads(f'"{literal}"')) if literal else "")
+            elif char_class or count:
+                out.append(char_class or count)
+            elif ref:
+                out.append(f"(?:{convert(ref)})")
+            else:
+                out.append("(?:" if op == "(" else op)
+        return "".join(out)
+
+    return re.compile(convert(rule), re.DOTALL)
+
+
+def call(name, arguments):
+    return {"id": "call_0", "type": "function", "function": {"name": name, "arguments": arguments}}
+
+
+@pytest.mark.parametrize("tool_format", ["hermes", "xml"])
+def test_grammar_references_only_defined_rules(tool_format):
+    grammar = rules(tool_call_grammar(TOOLS, tool_format))
+
+    assert list(grammar)[0] == "root"
+    for name, body in grammar.items():
+        assert referenced_rules(body) <= set(grammar), name
+
+
+def test_hermes_grammar_constrains_arguments():
+    grammar = rules(tool_call_grammar(TOOLS, "hermes"))
+
+    assert '"\\"name\\": \\"run_code_interpreter\\", \\"arguments\\": "' in grammar["tool0"]
+    assert grammar["tool0-args"].startswith('"{" ws "\\"code\\"" ":" ws string')
+    assert '( "," ws "\\"timeout\\"" ":" ws integer )?' in grammar["tool0-args"]
+    assert grammar["tool1-args-mode"] == '( "\\"fast\\"" | "\\"slow\\"" ) ws'
+
+
+def test_xml_grammar_uses_parameter_tags():
+    grammar = rules(tool_call_grammar(TOOLS, "xml"))
+
+    assert grammar["tool0"].startswith('"<function=run_code_interpreter>"')
+    assert grammar["tool0-params"].startswith('"<parameter=code>" "\\n" xml-value')
+    assert grammar["tool0-params"].endswith('"</parameter>" "\\n" )?')
+
+
+def test_constraints_are_lazy_and_can_be_disabled(monkeypatch):
+    constraints = tool_call_constraints(TOOLS, "hermes")
+    assert constraints["grammar_lazy"] is True
+    assert constraints["grammar_triggers"] == [{"type": GRAMMAR_TRIGGER_TYPE_WORD, "value": "<tool_call>"}]
+    assert tool_call_constraints([], "hermes") == {}
+
+    monkeypatch.setattr(tool_grammar, "TOOL_GRAMMAR_ENABLED", False)
+    assert tool_call_constraints(TOOLS, "hermes") == {}
+
+
+def test_validate_tool_call():
+    assert validate_tool_call(call("run_code_interpreter", '{"code": "1"}'), TOOLS) == (True, "")
+    assert validate_tool_call(call("missing", "{}"), TOOLS)[1] == "unknown tool 'missing'"
+    assert "not valid JSON" in validate_tool_call(call("run_code_interpreter", '{"code": '), TOOLS)[1]
+    assert validate_tool_call(call("run_code_interpreter", '["1"]'), TOOLS)[1] == "arguments are not a JSON object"
+    assert validate_tool_call(call("run_code_interpreter", "{}"), TOOLS)[1] == "missing required arguments ['code']"
+
+
+def test_tool_call_stats(monkeypatch):
+    monkeypatch.setattr(tool_grammar, "_tool_call_stats", {})
+    record_tool_call("raw", True)
+    record_tool_call("raw", False)
+    record_tool_call("raw+grammar", True)
+
+    assert tool_call_stats() == {
+        "raw": {"calls": 2, "malformed": 1, "malformed_rate": 0.5},
+        "raw+grammar": {"calls": 1, "malformed": 0, "malformed_rate": 0.0},
+    }
+
+
+def test_object_arguments_without_required_keys_are_still_objects():
+    tools = [
+        {"type": "function", "function": {"name": "where", "parameters": {"type": "object", "properties": {}, "required": []}}},
+        {"type": "function", "function": {"name": "find", "parameters": {
+            "type": "object",
+            "properties": {"a": {"type": "string"}, "b": {"type": "integer"}},
+        }}},
+    ]
+    grammar = to_regex(tool_call_grammar(tools, "hermes"))
+
+    def accepts(name, arguments):
+        return grammar.fullmatch(f'<tool_call>\n{{"name": "{name}", "arguments": {arguments}}}\n</tool_call>') is not None
+
+    assert accepts("where", "{}")
+    assert not accepts("where", '"foo"')
+    assert not accepts("where", "[1]")
+    assert not accepts("where", '{"x": 1}')
+    for arguments in ("{}", '{"a": "x"}', '{"b": 2}', '{"a": "x", "b": 2}'):
+        assert accepts("find", arguments), arguments
+    for arguments in ('{, "b": 2}', '{"b": 2, "a": "x"}', '{"c": 1}', '"foo"'):
+        assert not accepts("find", arguments), arguments
+
+
+def test_free_form_object_parameters_accept_any_object():
+    tools = [{"type": "function", "function": {"name": "f", "parameters": {
+        "type": "object", "properties": {"options": {"type": "object"}}, "required": ["options"],
+    }}}]
+    assert rules(tool_call_grammar(tools, "hermes"))["tool0-args"].endswith('ws object "}" ws')
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import threading
+import time
+
+from src import sandbox_manager
+from src.streaming import function_worker_async
+
+
+def test_calls_of_one_session_run_in_order():
+    events = []
+
+    async def tool(tool_call, files, session_id):
+        events.append(("start", session_id, tool_call["id"]))
+        await asyncio.sleep(0.02 if tool_call["id"] == "a1" else 0)
+        events.append(("end", session_id, tool_call["id"]))
+        return {"role": "tool", "tool_call_id": tool_call["id"], "content": ""}
+
+    async def main():
+        calls, results = asyncio.Queue(), asyncio.Queue()
+        workers = [asyncio.create_task(function_worker_async(tool, calls, results)) for _ in range(4)]
+        for session_id, call_id in [("a", "a1"), ("a", "a2"), ("b", "b1"), ("a", "a3")]:
+            calls.put_nowait({"tool_call": json.dumps({"id": call_id}), "session_id": session_id})
+        done = [await results.get() for _ in range(4)]
+        for _ in workers:
+            calls.put_nowait(None)
+        await asyncio.gather(*workers)
+        return done
+
+    done = asyncio.run(main())
+    session_a = [event for event in events if event[1] == "a"]
+    assert session_a == [(kind, "a", call) for call in ("a1", "a2", "a3") for kind in ("start", "end")]
+    # Another session's call doesn't wait for session a.
+    assert events.index(("end", "b", "b1")) < events.index(("end", "a", "a1"))
+    assert len(done) == 4
+
+
+def test_busy_session_does_not_hold_other_workers():
+    async def main():
+        gate = asyncio.Event()
+
+        async def tool(tool_call, files, session_id):
+            if session_id == "a":
+                await gate.wait()
+            return {"role": "tool", "tool_call_id": tool_call["id"], "content": ""}
+
+        calls, results = asyncio.Queue(), asyncio.Queue()
+        workers = [asyncio.create_task(function_worker_async(tool, calls, results)) for _ in range(2)]
+        for session_id, call_id in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")]:
+            calls.put_nowait({"tool_call": json.dumps({"id": call_id}), "session_id": session_id})
+        # Session a has more calls than there are workers; b still gets through.
+        first = await asyncio.wait_for(results.get(), 1)
+        gate.set()
+        rest = [await asyncio.wait_for(results.get(), 1) for _ in range(3)]
+        for _ in workers:
+            calls.put_nowait(None)
+        await asyncio.gather(*workers)
+        return first, rest
+
+    first, rest = asyncio.run(main())
+    assert first["tool_call_id"] == "b1"
+    assert [res["tool_call_id"] for res in rest] == ["a1", "a2", "a3"]
+
+
+class FakeStore:
+    def __init__(self):
+        self.fields = {}
+
+    def get(self, session_id):
+        return self.fields.get(session_id)
+
+    def update(self, session_id, **fields):
+        self.fields.setdefault(session_id, {}).update(fields)
+
+
+def test_get_sandbox_creates_one_sandbox_per_session(monkeypatch):
+    created = []
+    gate = threading.Barrier(4)
+
+    class FakeSandbox:
+        @staticmethod
+        def create(api_key=None, timeout=None):
+            time.sleep(0.05)
+            sbx = FakeSandbox()
+            sbx.sandbox_id = f"sbx-{len(created)}"
+            created.append(sbx)
+            return sbx
+
+    monkeypatch.setattr(sandbox_manager, "_sandbox_cls", lambda: FakeSandbox)
+    monkeypatch.setattr(sandbox_manager, "get_session_store", lambda: FakeStore())
+    monkeypatch.setattr(sandbox_manager, "sandboxes", {})
+
+    handles = []
+
+    def attach():
+        gate.wait()
+        handles.append(sandbox_manager.get_sandbox("s1"))
+
+    threads = [threading.Thread(target=attach) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(created) == 1
+    assert all(handle is created[0] for handle in handles)
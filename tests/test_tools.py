@@ -0,0 +1,105 @@
+import asyncio
+import json
+import threading
+from typing import Optional
+
+import pytest
+
+from src import tools
+from src.tools import TransientToolError, invoke_tool, tool
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(tools, "TOOLS", dict(tools.TOOLS))
+    monkeypatch.setattr(tools, "RETRY_BACKOFF_SECONDS", 0)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_schema_is_derived_from_the_signature():
+    @tool(params={"code": "Code to run."})
+    def runner(code: str, limit: Optional[int] = None, files: list = None, session_id: str = None) -> str:
+        """Runs code."""
+
+    schema = tools.TOOLS["runner"].schema["function"]
+    assert schema["description"] == "Runs code."
+    assert schema["parameters"] == {
+        "type": "object",
+        "properties": {
+            "code": {"type": "string", "description": "Code to run."},
+            "limit": {"type": "integer"},
+        },
+        "required": ["code"],
+    }
+    assert tools.TOOLS["runner"].context == ("files", "session_id")
+
+
+def test_arguments_are_coerced():
+    @tool()
+    async def echo(code: str) -> str:
+        return code
+
+    assert run(invoke_tool("echo", '{"code": "a"}', {})) == ("a", False)
+    assert run(invoke_tool("echo", json.dumps('{"code": "b"}'), {})) == ("b", False)
+    assert run(invoke_tool("echo", json.dumps("print(1)"), {})) == ("print(1)", False)
+    content, is_error = run(invoke_tool("echo", "{bad", {}))
+    assert is_error and content.startswith("Invalid arguments for echo")
+    assert run(invoke_tool("missing", "{}", {}))[1] is True
+
+
+def test_transient_errors_are_retried():
+    attempts = []
+
+    @tool(retries=2)
+    async def flaky() -> dict:
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise TransientToolError("try again")
+        return {"ok": True}
+
+    assert run(invoke_tool("flaky", "{}", {})) == ('{"ok": true}', False)
+    assert tools.TOOLS["flaky"].stats["retries"] == 2
+
+
+def test_async_timeout_is_reported():
+    @tool(timeout=0.01, retries=1)
+    async def slow() -> str:
+        await asyncio.sleep(1)
+
+    content, is_error = run(invoke_tool("slow", "{}", {}))
+    stats = tools.TOOLS["slow"].stats
+    assert is_error and "timed out" in content
+    assert (stats["timeouts"], stats["errors"], stats["in_flight"]) == (2, 1, 0)
+
+
+def test_blocking_tool_keeps_its_slot_until_the_thread_returns():
+    release = threading.Event()
+    started = []
+
+    @tool(timeout=0.05, concurrency=1)
+    def blocking(label: str) -> str:
+        started.append(label)
+        if label == "first":
+            release.wait(5)
+        return label
+
+    spec = tools.TOOLS["blocking"]
+
+    async def main():
+        content, is_error = await invoke_tool("blocking", '{"label": "first"}', {})
+        assert is_error and "timed out" in content
+        # The thread is still running, so the only slot is still taken.
+        assert spec.stats["in_flight"] == 1
+        second = asyncio.create_task(invoke_tool("blocking", '{"label": "second"}', {}))
+        await asyncio.sleep(0.05)
+        assert started == ["first"]
+        release.set()
+        assert await second == ("second", False)
+        await asyncio.sleep(0.01)
+
+    run(main())
+    assert spec.stats["in_flight"] == 0
+    spec.executor.shutdown()
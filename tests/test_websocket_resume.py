@@ -0,0 +1,123 @@
+import asyncio
+import json
+import time
+
+import pytest
+from fastapi import WebSocketDisconnect
+from fastapi.testclient import TestClient
+
+import src.app as app_module
+
+
+async def fake_stream(messages=None, tools=None, client_cfg=None, **kwargs):
+    yield [{"delta": {"content": "An answer.\n\n"}}]
+    yield [{"delta": {}, "finish_reason": "stop"}]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app_module, "astream_llama_cpp_response", fake_stream)
+    monkeypatch.setitem(app_module.client_cfg, "mode", "chat")
+    with TestClient(app_module.app) as client:
+        yield client
+
+
+def wait_until(condition, timeout=2.0):
+    # The server handles a close asynchronously after the client side returns.
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def run_turn(ws, prompt):
+    ws.send_text(json.dumps({"prompt": prompt}))
+    frames = []
+    while True:
+        frame = json.loads(ws.receive_text())
+        frames.append(frame)
+        if frame[0] == "r" and "An answer." in frame[2] and not frame[3]:
+            return frames
+
+
+def test_resume_clears_chat_then_replays_and_rebuilds_history(client):
+    with client.websocket_connect("/ws?proto=compact") as ws:
+        op, session_id = json.loads(ws.receive_text())
+        assert op == "k"
+        run_turn(ws, "first question")
+
+    state = app_module.get_session_store().get(session_id)
+    assert "chat_history" not in state
+
+    with client.websocket_connect(f"/ws?proto=compact&session={session_id}") as ws:
+        assert json.loads(ws.receive_text()) == ["k", session_id]
+        assert json.loads(ws.receive_text()) == ["c"]
+        user = json.loads(ws.receive_text())
+        answer = json.loads(ws.receive_text())
+        assert user[:2] == ["n", "user"] and "first question" in user[3]
+        assert answer[:2] == ["n", "answer"]
+
+    turns = app_module.get_session_store().get_turns(session_id)
+    assert [m["role"] for m in turns[0]["messages"]] == ["user", "assistant"]
+
+
+def test_sandbox_close_waits_for_last_connection(client):
+    with client.websocket_connect("/ws?proto=compact") as first:
+        session_id = json.loads(first.receive_text())[1]
+        with client.websocket_connect(f"/ws?proto=compact&session={session_id}") as second:
+            second.receive_text()
+        # The first tab is still attached, so no close may be scheduled.
+        assert wait_until(lambda: app_module.agent_context["attached"].get(session_id) == 1)
+        assert session_id not in app_module.agent_context["pending_closes"]
+    assert wait_until(lambda: session_id in app_module.agent_context["pending_closes"])
+
+
+def test_store_calls_run_off_the_event_loop(client, monkeypatch):
+    store = app_module.get_session_store()
+    loop_threads = set()
+
+    class RecordingStore:
+        def __getattr__(self, name):
+            method = getattr(store, name)
+
+            def call(*args, **kwargs):
+                try:
+                    asyncio.get_running_loop()
+                    loop_threads.add(name)
+                except RuntimeError:
+                    pass
+                return method(*args, **kwargs)
+            return call
+
+    monkeypatch.setattr(app_module, "get_session_store", lambda: RecordingStore())
+    with client.websocket_connect("/ws?proto=compact") as ws:
+        session_id = json.loads(ws.receive_text())[1]
+        run_turn(ws, "question")
+    with client.websocket_connect(f"/ws?proto=compact&session={session_id}") as ws:
+        ws.receive_text()
+    assert wait_until(lambda: session_id in app_module.agent_context["pending_closes"])
+    assert loop_threads == set()
+
+
+def test_drop_during_replay_still_schedules_close(client, monkeypatch):
+    with client.websocket_connect("/ws?proto=compact") as ws:
+        session_id = json.loads(ws.receive_text())[1]
+        run_turn(ws, "question")
+    assert wait_until(lambda: session_id in app_module.agent_context["pending_closes"])
+
+    real_get_emitter = app_module.get_emitter
+
+    def dropping_emitter(websocket):
+        emitter = real_get_emitter(websocket)
+
+        async def user_bubble(html):
+            raise WebSocketDisconnect(1006)
+        emitter.user_bubble = user_bubble
+        return emitter
+
+    monkeypatch.setattr(app_module, "get_emitter", dropping_emitter)
+    with client.websocket_connect(f"/ws?proto=compact&session={session_id}") as ws:
+        ws.receive_text()
+        ws.receive_text()
+    assert wait_until(lambda: session_id not in app_module.agent_context["attached"])
+    assert wait_until(lambda: session_id in app_module.agent_context["pending_closes"])